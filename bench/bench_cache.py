@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Michael Liao'
+
+'''
+Benchmark throughput and latency of transwarp.cache clients.
+
+MemcacheClient and RedisClient run against in-process stand-in servers of
+transwarp.cacheserver unless real servers are given, so results of the two
+measure client and protocol overhead rather than server performance.
+
+Usage:
+
+  python bench/bench_cache.py [-n number] [-s size] [--memcache host:port] [--redis host:port] [-o result.json] [-c baseline.json]
+'''
+
+import os, sys, json, time, platform, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp import cache, cacheserver
+
+def _operations(c, size):
+    value = dict(name='x' * size, id=123)
+    keys = ['bench:%d' % i for i in range(10)]
+    c.sets(dict([(k, value) for k in keys]))
+    def set_():
+        c.set('bench:0', value)
+    def get():
+        return c.get('bench:0')
+    def gets_10():
+        return c.gets(*keys)
+    def get_miss():
+        return c.get('bench:none')
+    def incr():
+        return c.incr('bench:counter')
+    return [('set', set_), ('get', get), ('gets_10', gets_10), ('get_miss', get_miss), ('incr', incr)]
+
+def _measure(func, number):
+    func()
+    L = [0.0] * number
+    start = time.time()
+    for i in xrange(number):
+        t = time.time()
+        func()
+        L[i] = time.time() - t
+    total = time.time() - start
+    L.sort()
+    return dict(ops=number / total, p50=L[number // 2] * 1000000, p99=L[min(number - 1, number * 99 // 100)] * 1000000)
+
+def run(c, number, size):
+    '''
+    Run all operations by client and return dict of results.
+    '''
+    return dict([(name, _measure(func, number)) for name, func in _operations(c, size)])
+
+def _report(results, baseline):
+    for client in sorted(results):
+        print('== %s' % client)
+        for name, r in sorted(results[client].iteritems()):
+            s = '%-10s %10.0f ops/sec  p50 %8.1f us  p99 %8.1f us' % (name, r['ops'], r['p50'], r['p99'])
+            base = baseline.get(client, {}).get(name) if baseline else None
+            if base:
+                s = '%s %+7.1f%%' % (s, (r['ops'] / base['ops'] - 1.0) * 100)
+            print(s)
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark transwarp.cache clients.')
+    parser.add_argument('-n', '--number', type=int, default=5000, help='operations per benchmark')
+    parser.add_argument('-s', '--size', type=int, default=100, help='size of string in cached value')
+    parser.add_argument('--memcache', help='memcache server, default to in-process stand-in server')
+    parser.add_argument('--redis', help='redis server, default to in-process stand-in server')
+    parser.add_argument('-o', '--output', help='save results as json file')
+    parser.add_argument('-c', '--compare', help='compare with results saved in json file')
+    args = parser.parse_args()
+    servers = []
+    if not args.memcache:
+        servers.append(cacheserver.MemcacheServer().start())
+        args.memcache = servers[-1].address
+    if not args.redis:
+        servers.append(cacheserver.RedisServer().start())
+        args.redis = servers[-1].address
+    try:
+        results = {
+            'LocalClient': run(cache.LocalClient(), args.number, args.size),
+            'MemcacheClient': run(cache.MemcacheClient(args.memcache), args.number, args.size),
+            'RedisClient': run(cache.RedisClient(args.redis), args.number, args.size),
+        }
+    finally:
+        for s in servers:
+            s.stop()
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    _report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(python=platform.python_version(), time=time.time(), number=args.number, size=args.size, results=results), f, indent=2, sort_keys=True)
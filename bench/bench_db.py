@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Michael Liao'
+
+'''
+Benchmark overhead of transwarp.db against sqlite3 file and :memory: database.
+
+Each operation reports ops/sec and objs/op. objs/op is the number of gc-tracked
+objects allocated per operation and still alive when the operation returns
+(e.g. Dict rows of results), and bytes/op is the peak memory allocated per
+operation when tracemalloc is available.
+
+Usage:
+
+  python bench/bench_db.py [-n number] [-r rows] [-o result.json] [-c baseline.json]
+'''
+
+import os, sys, gc, json, time, tempfile, platform, argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp import db
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class BenchUser(db.Model):
+    __table__ = 'user'
+    id = db.IntegerField(primary_key=True)
+    name = db.StringField()
+    email = db.StringField()
+    passwd = db.StringField()
+    last_modified = db.FloatField()
+
+def _create_schema(rows):
+    db.update('create table user (id int primary key, name text, email text, passwd text, last_modified real)')
+    with db.transaction():
+        for i in range(rows):
+            db.insert('user', id=i, name='User-%s' % i, email='user-%s@test.org' % i, passwd='passwd', last_modified=time.time())
+
+def _operations(rows, memory):
+    ids = iter(xrange(rows, sys.maxint))
+    def select_one():
+        return db.select_one('select * from user where id=?', 1)
+    def select_n():
+        return db.select('select * from user where id<?', rows)
+    def insert():
+        return db.insert('user', id=next(ids), name='Bob', email='bob@test.org', passwd='passwd', last_modified=0.0)
+    def get_by_id():
+        return BenchUser.get_by_id(1)
+    u = BenchUser.get_by_id(2)
+    def model_update():
+        return u.update()
+    def transaction():
+        with db.transaction():
+            db.update('update user set last_modified=? where id=?', 1.0, 3)
+            return db.select_one('select * from user where id=?', 3)
+    L = [('select_one', select_one), ('select_%d' % rows, select_n), ('insert', insert), \
+         ('Model.get_by_id', get_by_id), ('Model.update', model_update), ('transaction', transaction)]
+    if not memory:
+        # every connection of :memory: opens an empty database:
+        def connection():
+            db._db_ctx.cleanup()
+            db._db_ctx.connection = None
+            try:
+                return select_one()
+            finally:
+                db._db_ctx.init()
+        L.append(('connection', connection))
+    return L
+
+def _measure(func, number):
+    func()
+    gc.collect()
+    gc.disable()
+    try:
+        results = [None] * number
+        n0 = gc.get_count()[0]
+        start = time.time()
+        for i in xrange(number):
+            results[i] = func()
+        t = time.time() - start
+        objs = float(gc.get_count()[0] - n0) / number
+    finally:
+        gc.enable()
+    del results
+    nbytes = None
+    if tracemalloc:
+        tracemalloc.start()
+        for i in xrange(min(number, 100)):
+            func()
+        nbytes = tracemalloc.get_traced_memory()[1] / min(number, 100)
+        tracemalloc.stop()
+    return dict(ops=number / t, objs=objs, bytes=nbytes)
+
+def run(database, number, rows):
+    '''
+    Run all operations against database and return dict of results.
+    '''
+    memory = database==':memory:'
+    db.init('sqlite3', database, '')
+    results = dict()
+    with db.connection():
+        _create_schema(rows)
+        for name, func in _operations(rows, memory):
+            results[name] = _measure(func, number)
+    return results
+
+def _report(results, baseline):
+    for database in sorted(results):
+        print('== %s' % database)
+        for name, r in sorted(results[database].iteritems()):
+            s = '%-16s %10.0f ops/sec %8.1f objs/op' % (name, r['ops'], r['objs'])
+            if r['bytes'] is not None:
+                s = '%s %8d bytes/op' % (s, r['bytes'])
+            base = baseline.get(database, {}).get(name) if baseline else None
+            if base:
+                s = '%s %+7.1f%%' % (s, (r['ops'] / base['ops'] - 1.0) * 100)
+            print(s)
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark transwarp.db on sqlite3.')
+    parser.add_argument('-n', '--number', type=int, default=2000, help='operations per benchmark')
+    parser.add_argument('-r', '--rows', type=int, default=100, help='rows selected by select_N')
+    parser.add_argument('-o', '--output', help='save results as json file')
+    parser.add_argument('-c', '--compare', help='compare with results saved in json file')
+    args = parser.parse_args()
+    dbfile = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3.db')
+    try:
+        results = {
+            'file': run(dbfile, args.number, args.rows),
+            ':memory:': run(':memory:', args.number, args.rows),
+        }
+    finally:
+        if os.path.isfile(dbfile):
+            os.remove(dbfile)
+        os.rmdir(os.path.dirname(dbfile))
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    _report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(python=platform.python_version(), time=time.time(), number=args.number, rows=args.rows, results=results), f, indent=2, sort_keys=True)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Michael Liao'
+
+'''
+Benchmark id generators of transwarp.db.
+
+Usage: python bench/bench_id.py [number]
+'''
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp import db
+
+def bench(name, func, number):
+    t = min(timeit.repeat(func, repeat=3, number=number))
+    sample = func()
+    print('%-16s %10.0f ops/sec  %3d chars  e.g. %s' % (name, number / t, len(str(sample)), sample))
+
+if __name__=='__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench('next_str', db.next_str, number)
+    bench('next_long', db.next_long, number)
+    bench('next_short_str', db.next_short_str, number)
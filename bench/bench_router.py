@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Michael Liao'
+
+'''
+Benchmark route dispatchers of transwarp.web for 10, 100 and 1000 routes.
+
+Each route table has routes like '/api/res<N>/<id>' and '/res<N>/<id>/edit' in
+the order of WSGIApplication, and paths hit the first, middle and last route
+or miss all of them.
+
+Usage: python bench/bench_router.py [number]
+'''
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transwarp import web
+
+def _routes(n):
+    L = []
+    for i in range(n // 2):
+        L.append(web.Route('/api/res%d/<id>' % i, None))
+        L.append(web.Route('/res%d/<id>/edit' % i, None))
+    L.append(web.Route('/static/<path:path>', None))
+    L.append(web.Route('/favicon.ico', None))
+    return L
+
+def _paths(n):
+    return [('first', '/api/res0/123'), ('middle', '/res%d/123/edit' % (n // 4)), \
+            ('last', '/res%d/123/edit' % (n // 2 - 1)), ('static', '/static/js/app.js'), ('miss', '/no/such/path')]
+
+def bench(n, number):
+    routes = _routes(n)
+    routers = [(name, web._routers[name](routes)) for name in ('linear', 'trie', 'regex')]
+    print('== %d routes' % n)
+    print('%-8s %s' % ('', ''.join(['%12s' % name for name, r in routers])))
+    for label, path in _paths(n):
+        L = []
+        for name, r in routers:
+            t = min(timeit.repeat(lambda: r.match(path), repeat=3, number=number))
+            L.append('%9.2f us' % (t / number * 1000000))
+        print('%-8s %s' % (label, ''.join(L)))
+
+if __name__=='__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for n in (10, 100, 1000):
+        bench(n, number)
@@ -0,0 +1,793 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Michael Liao'
+
+'''
+Non-blocking cache clients for event-driven services.
+
+AsyncRedisClient and AsyncMemcacheClient have the same methods as the clients
+of transwarp.cache but return Future immediately. Requests are queued to a
+pool of connections and pipelined: many requests are in flight on one
+connection, which is connected and written by a writer thread, and replies
+are matched in order by a reader thread.
+Values are encoded as the sync clients do, so both share keys and values.
+Values set with tags by the sync clients are checked against tag versions and
+treated as not found if any tag is invalidated.
+
+Callbacks of Future run in the I/O threads and must not block. Event loops
+should hand the result over by their thread-safe call, e.g.:
+
+    f = client.get('user:1')
+    f.add_done_callback(lambda f: io_loop.add_callback(handle, f))
+'''
+
+import os, re, time, socket, threading, itertools, logging, collections
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from cache import Codec, _safe_loads, _safe_int, _is_tagged, _tag_key
+
+class TimeoutError(Exception):
+    pass
+
+class ReplyError(Exception):
+    pass
+
+class MemcachedKeyError(Exception):
+    pass
+
+class MemcachedKeyLengthError(MemcachedKeyError):
+    pass
+
+class MemcachedKeyCharacterError(MemcachedKeyError):
+    pass
+
+class Future(object):
+    '''
+    Result of asynchronous call.
+
+    >>> f = Future()
+    >>> f.add_done_callback(lambda f: results.append(f.result()))
+    >>> results = []
+    >>> f.done()
+    False
+    >>> f.set_result(123)
+    >>> f.done(), f.result(), results
+    (True, 123, [123])
+    >>> f = Future()
+    >>> f.result(0.1)
+    Traceback (most recent call last):
+      ...
+    TimeoutError: timeout
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise TimeoutError('timeout')
+
+    def result(self, timeout=None):
+        '''
+        Wait and return result, or raise exception of the call.
+        '''
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        '''
+        Call fn(future) when done, or immediately if already done.
+        '''
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result, exception):
+        with self._cond:
+            self._result = result
+            self._exception = exception
+            self._done = True
+            self._cond.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logging.exception('callback of future failed.')
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+def _then(future, fn):
+    '''
+    Return Future of fn(result of future).
+    '''
+    f = Future()
+    def _done(r):
+        e = r.exception()
+        if e is not None:
+            return f.set_exception(e)
+        try:
+            f.set_result(fn(r.result()))
+        except Exception, e:
+            f.set_exception(e)
+    future.add_done_callback(_done)
+    return f
+
+def _chain(future, fn):
+    '''
+    Return Future of the result of Future returned by fn(result of future).
+    '''
+    f = Future()
+    def _done(r):
+        e = r.exception()
+        if e is not None:
+            return f.set_exception(e)
+        try:
+            g = fn(r.result())
+        except Exception, e:
+            return f.set_exception(e)
+        g.add_done_callback(lambda g: f._set(g._result, g._exception))
+    future.add_done_callback(_done)
+    return f
+
+def _gather(futures, fn=list):
+    '''
+    Return Future of fn(list of results) when all futures are done.
+    '''
+    f = Future()
+    if not futures:
+        f.set_result(fn([]))
+        return f
+    results = [None] * len(futures)
+    remain = [len(futures)]
+    lock = threading.Lock()
+    def _done(i, r):
+        results[i] = r
+        with lock:
+            remain[0] = remain[0] - 1
+            if remain[0]:
+                return
+        for r in results:
+            if r.exception() is not None:
+                return f.set_exception(r.exception())
+        f.set_result(fn([r.result() for r in results]))
+    for i, future in enumerate(futures):
+        future.add_done_callback(lambda r, i=i: _done(i, r))
+    return f
+
+class _Reader(object):
+    '''
+    Buffered reader of socket. When socket timed out it waits again unless 
+    expired() returns True, so buffered data of a reply is never lost.
+    '''
+    def __init__(self, sock, expired):
+        self._sock = sock
+        self._expired = expired
+        self._buf = ''
+        self._pos = 0
+
+    def _more(self):
+        while True:
+            try:
+                data = self._sock.recv(65536)
+                break
+            except socket.timeout:
+                if self._expired():
+                    raise
+        if not data:
+            raise socket.error('connection closed')
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+
+    def readline(self):
+        i = self._buf.find('\n', self._pos)
+        while i < 0:
+            start = len(self._buf) - self._pos
+            self._more()
+            i = self._buf.find('\n', start)
+        line = self._buf[self._pos:i + 1]
+        self._pos = i + 1
+        return line
+
+    def read(self, n):
+        while len(self._buf) - self._pos < n:
+            self._more()
+        data = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return data
+
+class _Connection(object):
+    '''
+    Pipelined connection. Requests are queued with their futures, and a writer 
+    thread connects and writes them while a reader thread reads replies in order, 
+    so send() never blocks. Failing to connect, sending a request or waiting for 
+    reply of the oldest request longer than timeout fails all pending requests 
+    and closes connection.
+    '''
+    def __init__(self, address, connect_timeout, timeout, read_reply):
+        self._address = address
+        self._connect_timeout = connect_timeout
+        self._timeout = timeout
+        self._read_reply = read_reply
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pending = collections.deque()
+        self._outgoing = []
+        self._sock = None
+        self.closed = False
+        t = threading.Thread(target=self._write_loop, name='async-cache-%s:%s' % address)
+        t.daemon = True
+        t.start()
+
+    def send(self, data, fn):
+        '''
+        Queue request and return Future of fn(reply).
+        '''
+        f = Future()
+        with self._lock:
+            if not self.closed:
+                self._pending.append((f, fn, time.time()))
+                self._outgoing.append(data)
+                self._cond.notify()
+                return f
+        f.set_exception(socket.error('connection closed'))
+        return f
+
+    def _expired(self):
+        with self._lock:
+            return bool(self._pending) and time.time() - self._pending[0][2] >= self._timeout
+
+    def _fail(self, e):
+        with self._lock:
+            failed = self._close()
+        # fail futures without lock so callbacks can send again:
+        for p in failed:
+            p.set_exception(e)
+
+    def _write_loop(self):
+        try:
+            sock = socket.create_connection(self._address, self._connect_timeout)
+            sock.settimeout(self._timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error, e:
+            return self._fail(e)
+        with self._lock:
+            if self.closed:
+                return sock.close()
+            self._sock = sock
+        t = threading.Thread(target=self._read_loop, name='async-cache-%s:%s' % self._address)
+        t.daemon = True
+        t.start()
+        try:
+            while True:
+                with self._lock:
+                    while not self._outgoing and not self.closed:
+                        self._cond.wait()
+                    if self.closed:
+                        return
+                    data, self._outgoing = ''.join(self._outgoing), []
+                sock.sendall(data)
+        except socket.error, e:
+            self._fail(e)
+
+    def _read_loop(self):
+        rfile = _Reader(self._sock, self._expired)
+        try:
+            while True:
+                r = self._read_reply(rfile)
+                f, fn, t = self._pending.popleft()
+                if isinstance(r, ReplyError):
+                    f.set_exception(r)
+                    continue
+                try:
+                    r = fn(r)
+                except Exception, e:
+                    f.set_exception(e)
+                else:
+                    f.set_result(r)
+        except Exception, e:
+            self._fail(e)
+
+    def _close(self):
+        '''
+        Close connection and return futures of pending requests. Must hold lock.
+        '''
+        if not self.closed:
+            self.closed = True
+            self._cond.notify_all()
+            if self._sock is not None:
+                try:
+                    self._sock.close()
+                except socket.error:
+                    pass
+        failed = [p[0] for p in self._pending]
+        self._pending.clear()
+        self._outgoing = []
+        return failed
+
+    def close(self):
+        self._fail(socket.error('connection closed'))
+
+class _AsyncClient(object):
+
+    def __init__(self, server, default_port, pool_size, connect_timeout, timeout):
+        host, port = server.split(':', 1) if ':' in server else (server, default_port)
+        self._address = (host, int(port))
+        self._connect_timeout = connect_timeout
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._conns = [None] * pool_size
+        self._pid = os.getpid()
+        self._next = itertools.count()
+
+    def _send(self, data, fn=lambda r: r):
+        '''
+        Send request by next connection of pool, reconnect if it is closed.
+        '''
+        if self._pid!=os.getpid():
+            # I/O threads do not exist after fork, so connect again:
+            with self._lock:
+                if self._pid!=os.getpid():
+                    self._conns = [None] * len(self._conns)
+                    self._pid = os.getpid()
+        n = next(self._next) % len(self._conns)
+        conn = self._conns[n]
+        if conn is None or conn.closed:
+            with self._lock:
+                conn = self._conns[n]
+                if conn is None or conn.closed:
+                    conn = self._conns[n] = _Connection(self._address, self._connect_timeout, self._timeout, self._read_reply)
+        return conn.send(data, fn)
+
+    def close(self):
+        with self._lock:
+            conns = [conn for conn in self._conns if conn is not None]
+        for conn in conns:
+            conn.close()
+
+    def _untag(self, L):
+        '''
+        Return Future of list that tagged objects are replaced by object, or None if 
+        any tag is invalidated, as BaseClient._untag() does.
+        '''
+        tagged = [i for i, r in enumerate(L) if _is_tagged(r)]
+        if not tagged:
+            f = Future()
+            f.set_result(L)
+            return f
+        tags = list(set([t for i in tagged for t in L[i][2]]))
+        def _check(versions):
+            versions = dict(zip(tags, versions))
+            for i in tagged:
+                r = L[i]
+                valid = all([versions[t]==v for t, v in r[2].iteritems()])
+                L[i] = r[1] if valid else None
+            return L
+        return _then(self.getints(*map(_tag_key, tags)), _check)
+
+    def _get(self, future, default):
+        '''
+        Return Future of object from future of one-item list, or default if not found.
+        '''
+        return _then(_chain(future, self._untag), lambda L: default if L[0] is None else L[0])
+
+    def getint(self, key, default=0):
+        return _then(self.get(key), lambda r: _safe_int(r, default))
+
+    def getints(self, *keys):
+        return _then(self.gets(*keys), lambda L: [_safe_int(r) for r in L])
+
+    def incrs(self, *keys):
+        return _gather([self.incr(key) for key in keys])
+
+def _utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else str(s)
+
+def _command(*args):
+    '''
+    Encode command as RESP array of bulk strings.
+
+    >>> _command('SET', 'key', 100)
+    '*3\\r\\n$3\\r\\nSET\\r\\n$3\\r\\nkey\\r\\n$3\\r\\n100\\r\\n'
+    '''
+    L = ['*%d\r\n' % len(args)]
+    for arg in args:
+        arg = _utf8(arg)
+        L.append('$%d\r\n%s\r\n' % (len(arg), arg))
+    return ''.join(L)
+
+def _read_exactly(rfile, n):
+    data = rfile.read(n)
+    if len(data) < n:
+        raise socket.error('connection closed')
+    return data
+
+def _read_resp(rfile):
+    line = rfile.readline()
+    if not line.endswith('\r\n'):
+        raise socket.error('connection closed')
+    t, s = line[0], line[1:-2]
+    if t=='+':
+        return s
+    if t=='-':
+        return ReplyError(s)
+    if t==':':
+        return int(s)
+    if t=='$':
+        n = int(s)
+        return None if n < 0 else _read_exactly(rfile, n + 2)[:-2]
+    if t=='*':
+        n = int(s)
+        return None if n < 0 else [_read_resp(rfile) for i in range(n)]
+    raise socket.error('bad reply: %r' % line)
+
+class AsyncRedisClient(_AsyncClient):
+    '''
+    Asynchronous client of one redis server compatible with RedisClient.
+
+    >>> import cache, cacheserver
+    >>> s = cacheserver.RedisServer().start()
+    >>> c = AsyncRedisClient(s.address)
+    >>> f = c.sets({'a': 'A', 'b': [1, 2]})
+    >>> c.get('a').result(), c.gets('a', 'b', 'x').result()
+    ('A', ['A', [1, 2], None])
+    >>> futures = [c.incr('hits') for i in range(100)]
+    >>> sorted([f.result() for f in futures])==range(1, 101)
+    True
+    >>> c.incrs_by({'hits': 10, 'stock': -1}).result()
+    {'hits': 110, 'stock': -1}
+    >>> cache.RedisClient(s.address).get('a'), cache.RedisClient(s.address).getint('hits')
+    ('A', 110)
+    >>> c.getint('hits').result(), c.getints('hits', 'x').result()
+    (110, [110, 0])
+    >>> c.add('a', 'X').result(), c.deletes('a', 'b').result(), c.get('a', 'N/A').result()
+    (False, None, 'N/A')
+    >>> cache.RedisClient(s.address).set('t', 'T', tags=['user'])
+    >>> c.get('t').result(), c.gets('t', 'x').result()
+    ('T', ['T', None])
+    >>> cache.RedisClient(s.address).invalidate_tag('user')
+    >>> c.get('t', 'N/A').result(), c.gets('t').result()
+    ('N/A', [None])
+    >>> c.close()
+    >>> s.stop()
+
+    Requests fail by timeout if server does not reply, but idle connections are 
+    kept open:
+
+    >>> s = cacheserver.RedisServer().start()
+    >>> c = AsyncRedisClient(s.address, pool_size=1, timeout=0.2)
+    >>> f = c.set('a', 'A')
+    >>> time.sleep(0.5)
+    >>> c.get('a').result()
+    'A'
+    >>> c.close()
+    >>> s.stop()
+    >>> mute = socket.socket()
+    >>> mute.bind(('127.0.0.1', 0))
+    >>> mute.listen(1)
+    >>> c = AsyncRedisClient('127.0.0.1:%d' % mute.getsockname()[1], timeout=0.2)
+    >>> f = c.get('a')
+    >>> f.exception(2)
+    timeout('timed out',)
+    >>> mute.close()
+
+    Connecting runs in I/O thread, and a client inherited by child process 
+    connects again:
+
+    >>> t = time.time()
+    >>> f = AsyncRedisClient('10.255.255.1:6379', connect_timeout=0.5).get('a')
+    >>> time.time() - t < 0.1, f.exception(2) is not None
+    (True, True)
+    >>> s = cacheserver.RedisServer().start()
+    >>> c = AsyncRedisClient(s.address, pool_size=1)
+    >>> c.set('a', 'A').result()
+    >>> pid = os.fork()
+    >>> if pid==0:
+    ...     try:
+    ...         os._exit(0 if c.get('a').result(2)=='A' else 1)
+    ...     finally:
+    ...         os._exit(2)
+    >>> os.waitpid(pid, 0)[1]
+    0
+    >>> c.close()
+    >>> s.stop()
+    '''
+    def __init__(self, server='localhost:6379', codec=None, pool_size=4, connect_timeout=0.5, timeout=1.0):
+        '''
+        Init AsyncRedisClient.
+
+        Args:
+            server: server as 'host[:port]', default to 'localhost:6379'.
+            codec: Codec of values, default to None (using Codec()).
+            pool_size: number of connections, default to 4.
+            connect_timeout: seconds to connect, default to 0.5.
+            timeout: seconds to send request or wait for reply, default to 1.0. None means no timeout.
+        '''
+        _AsyncClient.__init__(self, server, 6379, pool_size, connect_timeout, timeout)
+        self._codec = codec or Codec()
+        self._read_reply = _read_resp
+
+    def _set(self, key, value, expires, *options):
+        args = ['SET', key, value]
+        if expires:
+            args.extend(['EX', int(expires)])
+        args.extend(options)
+        return _command(*args)
+
+    def set(self, key, value, expires=0):
+        return self._send(self._set(key, self._codec.dumps(value), expires), lambda r: None)
+
+    def setint(self, key, value, expires=0):
+        return self._send(self._set(key, value, expires), lambda r: None)
+
+    def sets(self, mapping, expires=0):
+        return _gather([self.set(k, v, expires) for k, v in mapping.iteritems()], lambda L: None)
+
+    def add(self, key, value, expires=0):
+        return self._send(self._set(key, self._codec.dumps(value), expires, 'NX'), lambda r: r is not None)
+
+    def get(self, key, default=None):
+        return self._get(self._send(_command('GET', key), lambda r: [_safe_loads(self._codec, r)]), default)
+
+    def gets(self, *keys):
+        return _chain(self._send(_command('MGET', *keys), lambda L: [_safe_loads(self._codec, r) for r in L]), self._untag)
+
+    def getint(self, key, default=0):
+        return self._send(_command('GET', key), lambda r: _safe_int(r, default))
+
+    def getints(self, *keys):
+        return self._send(_command('MGET', *keys), lambda L: [_safe_int(r) for r in L])
+
+    def delete(self, key):
+        return self._send(_command('DEL', key), lambda r: None)
+
+    def deletes(self, *keys):
+        return self._send(_command('DEL', *keys), lambda r: None)
+
+    def incr(self, key, delta=1):
+        return self._send(_command('INCRBY', key, delta))
+
+    def incrs_by(self, mapping):
+        keys = mapping.keys()
+        return _gather([self.incr(k, mapping[k]) for k in keys], lambda L: dict(zip(keys, L)))
+
+    def decr(self, key, delta=1):
+        return self._send(_command('DECRBY', key, delta))
+
+# max length of memcache key:
+_MAX_KEY_LENGTH = 250
+
+_re_key_char = re.compile(r'[\x00-\x20\x7f]')
+
+def _memcache_key(key):
+    '''
+    Return key as str, or raise error if it is not a valid memcache key, as 
+    python-memcached does.
+
+    >>> _memcache_key(u'user:\\u4e2d')
+    'user:\\xe4\\xb8\\xad'
+    >>> _memcache_key('user 1')
+    Traceback (most recent call last):
+      ...
+    MemcachedKeyCharacterError: control characters not allowed
+    >>> _memcache_key('x' * 251)
+    Traceback (most recent call last):
+      ...
+    MemcachedKeyLengthError: key length is > 250
+    '''
+    key = _utf8(key)
+    if len(key) > _MAX_KEY_LENGTH:
+        raise MemcachedKeyLengthError('key length is > %d' % _MAX_KEY_LENGTH)
+    if _re_key_char.search(key):
+        raise MemcachedKeyCharacterError('control characters not allowed')
+    return key
+
+# flags of python-memcached:
+_FLAG_PICKLE = 1
+_FLAG_INTEGER = 2
+_FLAG_LONG = 4
+_FLAG_COMPRESSED = 8
+_FLAG_TEXT = 16
+
+def _read_memcache(rfile):
+    '''
+    Read one-line reply as str, or VALUE lines until END as list of (key, flags, data).
+    '''
+    line = rfile.readline()
+    if not line.endswith('\r\n'):
+        raise socket.error('connection closed')
+    line = line[:-2]
+    if line=='END':
+        return []
+    if not line.startswith('VALUE '):
+        if line.startswith(('ERROR', 'CLIENT_ERROR', 'SERVER_ERROR')):
+            return ReplyError(line)
+        return line
+    values = []
+    while line.startswith('VALUE '):
+        parts = line.split()
+        n = int(parts[3])
+        values.append((parts[1], int(parts[2]), _read_exactly(rfile, n + 2)[:-2]))
+        line = rfile.readline()[:-2]
+    if line!='END':
+        raise socket.error('bad reply: %r' % line)
+    return values
+
+class AsyncMemcacheClient(_AsyncClient):
+    '''
+    Asynchronous client of one memcache server compatible with MemcacheClient.
+
+    >>> import cache, cacheserver
+    >>> s = cacheserver.MemcacheServer().start()
+    >>> c = AsyncMemcacheClient(s.address)
+    >>> f = c.sets({'a': 'A', 'b': [1, 2], 'u': u'\\u4e2d'})
+    >>> c.get('a').result(), c.gets('a', 'b', 'u', 'x').result()
+    ('A', ['A', [1, 2], u'\\u4e2d', None])
+    >>> futures = [c.incr('hits') for i in range(100)]
+    >>> sorted([f.result() for f in futures])==range(1, 101)
+    True
+    >>> c.incrs_by({'hits': 10, 'stock': -1}).result()
+    {'hits': 110, 'stock': 0}
+    >>> cache.MemcacheClient(s.address).gets('a', 'b', 'hits')
+    ['A', [1, 2], 110]
+    >>> c.add('a', 'X').result(), c.deletes('a', 'b').result(), c.get('a', 'N/A').result()
+    (False, None, 'N/A')
+    >>> c.set('a b', 'X')
+    Traceback (most recent call last):
+      ...
+    MemcachedKeyCharacterError: control characters not allowed
+    >>> c.gets('a', 'x\\r\\nflush_all')
+    Traceback (most recent call last):
+      ...
+    MemcachedKeyCharacterError: control characters not allowed
+    >>> cache.MemcacheClient(s.address).set('t', 'T', tags=['user'])
+    >>> c.get('t').result(), c.gets('t', 'x').result()
+    ('T', ['T', None])
+    >>> cache.MemcacheClient(s.address).invalidate_tag('user')
+    >>> c.get('t', 'N/A').result(), c.gets('t').result()
+    ('N/A', [None])
+    >>> c.close()
+    >>> s.stop()
+    '''
+    def __init__(self, server='localhost:11211', codec=None, pool_size=4, connect_timeout=0.5, timeout=1.0):
+        '''
+        Init AsyncMemcacheClient.
+
+        Args:
+            server: server as 'host:port', default to 'localhost:11211'.
+            codec: Codec of values, default to None (pickled as memcache module does).
+            pool_size: number of connections, default to 4.
+            connect_timeout: seconds to connect, default to 0.5.
+            timeout: seconds to send request or wait for reply, default to 1.0. None means no timeout.
+        '''
+        _AsyncClient.__init__(self, server, 11211, pool_size, connect_timeout, timeout)
+        self._codec = codec
+        self._read_reply = _read_memcache
+
+    def _encode(self, value):
+        t = type(value)
+        if t==int:
+            return _FLAG_INTEGER, str(value)
+        if t==long:
+            return _FLAG_LONG, str(value)
+        if self._codec is not None:
+            return 0, self._codec.dumps(value)
+        if t==str:
+            return 0, value
+        if t==unicode:
+            return _FLAG_TEXT, value.encode('utf-8')
+        return _FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, flags, data):
+        if flags & _FLAG_COMPRESSED:
+            import zlib
+            data = zlib.decompress(data)
+        if flags & _FLAG_INTEGER:
+            return int(data)
+        if flags & _FLAG_LONG:
+            return long(data)
+        if flags & _FLAG_TEXT:
+            return data.decode('utf-8')
+        if flags & _FLAG_PICKLE:
+            return pickle.loads(data)
+        return data if self._codec is None else _safe_loads(self._codec, data)
+
+    def _store(self, cmd, key, value, expires):
+        flags, data = self._encode(value)
+        return self._send('%s %s %d %d %d\r\n%s\r\n' % (cmd, _memcache_key(key), flags, int(expires), len(data), data), \
+            lambda r: r=='STORED')
+
+    def set(self, key, value, expires=0):
+        return _then(self._store('set', key, value, expires), lambda r: None)
+
+    setint = set
+
+    def sets(self, mapping, expires=0):
+        return _gather([self.set(k, v, expires) for k, v in mapping.iteritems()], lambda L: None)
+
+    def add(self, key, value, expires=0):
+        return self._store('add', key, value, expires)
+
+    def _values(self, L):
+        return dict([(key, self._decode(flags, data)) for key, flags, data in L])
+
+    def get(self, key, default=None):
+        key = _memcache_key(key)
+        return self._get(self._send('get %s\r\n' % key, lambda L: [self._values(L).get(key)]), default)
+
+    def gets(self, *keys):
+        keys = [_memcache_key(key) for key in keys]
+        def _gets(L):
+            d = self._values(L)
+            return [d.get(key) for key in keys]
+        return _chain(self._send('get %s\r\n' % ' '.join(keys), _gets), self._untag)
+
+    def delete(self, key):
+        return self._send('delete %s\r\n' % _memcache_key(key), lambda r: None)
+
+    def deletes(self, *keys):
+        return _gather([self.delete(key) for key in keys], lambda L: None)
+
+    def _incr(self, cmd, key, delta, initial, f=None):
+        '''
+        Send incr or decr, and add initial value if key not found, or send again if 
+        other request added it first.
+        '''
+        f = f or Future()
+        def _added(r):
+            e = r.exception()
+            if e is not None:
+                return f.set_exception(e)
+            if r.result():
+                return f.set_result(initial)
+            self._incr(cmd, key, delta, initial, f)
+        def _done(r):
+            e = r.exception()
+            if e is not None:
+                return f.set_exception(e)
+            if r.result()=='NOT_FOUND':
+                return self.add(key, initial).add_done_callback(_added)
+            f.set_result(int(r.result()))
+        self._send('%s %s %d\r\n' % (cmd, _memcache_key(key), delta)).add_done_callback(_done)
+        return f
+
+    def incr(self, key, delta=1):
+        return self._incr('incr', key, delta, delta)
+
+    def incrs_by(self, mapping):
+        keys = mapping.keys()
+        futures = [self.incr(k, mapping[k]) if mapping[k] >= 0 else self.decr(k, -mapping[k]) for k in keys]
+        return _gather(futures, lambda L: dict(zip(keys, L)))
+
+    def decr(self, key, delta=1):
+        return self._incr('decr', key, delta, 0)
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
@@ -7,18 +7,407 @@ __author__ = 'Michael Liao'
 A simple cache interface.
 '''
 
-import os, time, datetime, functools, logging
+import os, re, math, time, atexit, inspect, uuid, zlib, bisect, random, struct, hashlib, marshal, weakref, datetime, functools, itertools, threading, logging, collections
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-class DummyClient(object):
+def _serializer(n):
+    '''
+    Return (dumps, loads) functions of serializer by index.
+    '''
+    if n==0:
+        return (lambda v: pickle.dumps(v, pickle.HIGHEST_PROTOCOL)), pickle.loads
+    if n==1:
+        return marshal.dumps, marshal.loads
+    if n==2:
+        import json
+        return (lambda v: json.dumps(v, separators=(',', ':'))), json.loads
+    import msgpack
+    return msgpack.packb, msgpack.unpackb
+
+def _compressor(n):
+    '''
+    Return (compress, decompress) functions of compressor by index.
+    '''
+    if n==1:
+        return zlib.compress, zlib.decompress
+    import lz4.block
+    return lz4.block.compress, lz4.block.decompress
+
+_SERIALIZERS = ('pickle', 'marshal', 'json', 'msgpack')
+_COMPRESSORS = (None, 'zlib', 'lz4')
+
+class Codec(object):
+    '''
+    Codec that serializes cache value to str and compresses it if size exceeds 
+    threshold. Encoded str starts with a header byte (1-12) of serializer and 
+    compressor, so any Codec can decode it. Str without header is decoded as pickle.
+
+    >>> c = Codec()
+    >>> c.loads(c.dumps([1, 'abc', {'x': None}]))
+    [1, 'abc', {'x': None}]
+    >>> s = c.dumps('Python' * 1000)
+    >>> len(s) < 100, c.loads(s)=='Python' * 1000
+    (True, True)
+    >>> j = Codec('json', None)
+    >>> j.dumps({'x': [1, 2]})
+    '\\x07{"x":[1,2]}'
+    >>> c.loads(j.dumps({'x': [1, 2]}))
+    {u'x': [1, 2]}
+    >>> c.loads(pickle.dumps(('legacy', 1)))
+    ('legacy', 1)
+    >>> Codec('yaml')
+    Traceback (most recent call last):
+      ...
+    ValueError: unsupported serializer: yaml
+    '''
+    def __init__(self, serializer='pickle', compressor='zlib', threshold=1024):
+        '''
+        Init Codec.
+
+        Args:
+            serializer: 'pickle', 'marshal', 'json' or 'msgpack', default to 'pickle'.
+            compressor: None, 'zlib' or 'lz4', default to 'zlib'.
+            threshold: min size in bytes to compress, default to 1024.
+        '''
+        if not serializer in _SERIALIZERS:
+            raise ValueError('unsupported serializer: %s' % serializer)
+        if not compressor in _COMPRESSORS:
+            raise ValueError('unsupported compressor: %s' % compressor)
+        self._serializer = _SERIALIZERS.index(serializer)
+        self._dumps = _serializer(self._serializer)[0]
+        self._compressor = _COMPRESSORS.index(compressor)
+        self._compress = _compressor(self._compressor)[0] if compressor else None
+        self._threshold = threshold
+        self._loaders = dict()
+
+    def dumps(self, value):
+        s = self._dumps(value)
+        c = 0
+        if self._compress and len(s) >= self._threshold:
+            z = self._compress(s)
+            if len(z) < len(s):
+                s, c = z, self._compressor
+        return '%s%s' % (chr(1 + self._serializer * 3 + c), s)
+
+    def loads(self, data):
+        h = ord(data[0]) - 1 if data else (-1)
+        if h < 0 or h >= 12:
+            return pickle.loads(data)
+        loader = self._loaders.get(h)
+        if loader is None:
+            loads = _serializer(h // 3)[1]
+            if h % 3:
+                decompress = _compressor(h % 3)[1]
+                loader = lambda s: loads(decompress(s))
+            else:
+                loader = loads
+            self._loaders[h] = loader
+        return loader(data[1:])
+
+class _Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+_flights = dict()
+_flights_lock = threading.Lock()
+
+def _single_flight(key, fn, wait=True, default=None):
+    '''
+    Call fn() only once for concurrent calls with same key in this process. Other 
+    callers wait and get the same result, or get default if wait is False.
+    '''
+    with _flights_lock:
+        f = _flights.get(key)
+        leader = f is None
+        if leader:
+            f = _flights[key] = _Flight()
+    if not leader:
+        if not wait:
+            return default
+        f.event.wait()
+        if f.error:
+            raise f.error
+        return f.value
+    try:
+        f.value = fn()
+        return f.value
+    except Exception, e:
+        f.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        f.event.set()
+
+class _Missing(object):
+    '''
+    Type of MISSING that is pickled as reference so it is still MISSING when loaded.
+    '''
+    def __reduce__(self):
+        return 'MISSING'
+
+    def __nonzero__(self):
+        return False
+
+    def __repr__(self):
+        return 'MISSING'
+
+# cached object that means 'known not exist', distinguished from None as 'not cached':
+MISSING = _Missing()
+
+class BloomFilter(object):
+    '''
+    Bloom filter that answers 'definitely not exist' for keys never added.
+
+    >>> b = BloomFilter(1000)
+    >>> for i in range(1000):
+    ...     b.add('user:%s' % i)
+    >>> all(['user:%s' % i in b for i in range(1000)])
+    True
+    >>> len([i for i in range(1000, 11000) if 'user:%s' % i in b]) < 200
+    True
+    '''
+    def __init__(self, capacity, error_rate=0.01):
+        '''
+        Init BloomFilter with expected number of keys and false positive rate.
+        '''
+        m = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) + 1
+        self._m = m
+        self._k = max(1, int(round(m * math.log(2) / capacity)))
+        self._bits = bytearray((m + 7) // 8)
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self._m for i in range(self._k)]
+
+    def add(self, key):
+        with self._lock:
+            for n in self._positions(key):
+                self._bits[n >> 3] |= (1 << (n & 7))
+
+    def __contains__(self, key):
+        for n in self._positions(key):
+            if not self._bits[n >> 3] & (1 << (n & 7)):
+                return False
+        return True
+
+_TAGGED = '__tagged__'
+
+def _tag_key(tag):
+    return '__tag__:%s' % tag
+
+def _is_tagged(r):
+    return isinstance(r, (tuple, list)) and len(r)==3 and r[0]==_TAGGED
+
+_XFETCH = '__xfetch__'
+
+def _is_xfetch(r):
+    return isinstance(r, (tuple, list)) and len(r)==4 and r[0]==_XFETCH
+
+def _computed(r):
+    '''
+    Return object of value read by get_or_compute(): None for MISSING, object of 
+    value wrapped with compute time and expire time, or value itself.
+    '''
+    if r is MISSING:
+        return None
+    return r[1] if _is_xfetch(r) else r
+
+class BaseClient(object):
+    '''
+    Base class of cache clients that implements high-level operations by get, set, 
+    add and delete.
+    '''
+
+    def invalidate_tag(self, tag):
+        '''
+        Invalidate all objects set with tag by increasing version of tag.
+
+        Object set with tags is stored with current versions of tags, and is treated 
+        as not found if any version changed when read. Reading tagged objects costs 
+        one extra getints() of tag versions.
+
+        >>> c = LocalClient()
+        >>> c.set('user:1', 'Bob', tags=['user', 'user:1'])
+        >>> c.sets({'user:2': 'Alice', 'user:3': 'Eve'}, tags=['user'])
+        >>> c.set('article:1', 'Hello', tags=['article'])
+        >>> c.gets('user:1', 'user:2', 'article:1')
+        ['Bob', 'Alice', 'Hello']
+        >>> c.invalidate_tag('user:1')
+        >>> c.get('user:1'), c.get('user:2')
+        (None, 'Alice')
+        >>> c.invalidate_tag('user')
+        >>> c.gets('user:2', 'user:3', 'article:1')
+        [None, None, 'Hello']
+        '''
+        self.incr(_tag_key(tag))
+
+    def _tag_versions(self, tags):
+        keys = map(_tag_key, tags)
+        versions = self.getints(*keys)
+        for i, v in enumerate(versions):
+            if not v:
+                # init version so an evicted tag key never matches old objects:
+                versions[i] = int(time.time() * 1000)
+                self.setint(keys[i], versions[i])
+        return dict(zip(tags, versions))
+
+    def _tag(self, value, versions):
+        return (_TAGGED, value, versions)
+
+    def _untag(self, L):
+        '''
+        Replace tagged objects in list by object, or None if any tag is invalidated.
+        '''
+        tagged = [i for i, r in enumerate(L) if _is_tagged(r)]
+        if tagged:
+            tags = list(set([t for i in tagged for t in L[i][2]]))
+            versions = dict(zip(tags, self.getints(*map(_tag_key, tags))))
+            for i in tagged:
+                r = L[i]
+                valid = all([versions[t]==v for t, v in r[2].iteritems()])
+                L[i] = r[1] if valid else None
+        return L
+
+    def set_missing(self, key, expires=60):
+        '''
+        Cache MISSING for key so get() returns MISSING instead of None (not cached).
+        Requires a codec that can pickle MISSING.
+
+        >>> c = LocalClient()
+        >>> c.set_missing('user:bob', 30)
+        >>> c.get('user:bob') is MISSING, c.get('user:eve') is None
+        (True, True)
+        '''
+        self.set(key, MISSING, expires)
+
+    def get_or_compute(self, key, fn, expires=0, beta=1.0, lock_expires=0, missing_expires=0, bloom=None):
+        '''
+        Get object by key, or call fn() to compute, cache and return the object.
+
+        Concurrent calls in one process compute only once. If lock_expires is set, 
+        a lock is added to cache so only one process computes, and others return the 
+        stale object or wait until the object is cached or lock expires. The object 
+        is refreshed early with a probability that increases as expire time is near 
+        and compute time is long (XFetch), use beta=0 to disable.
+
+        Cached object is wrapped with compute time and expire time, so the key 
+        should only be read by get_or_compute(). Objects set by set(), sets() or 
+        warm_up() are plain hits that are never refreshed early, and MISSING set by 
+        set_missing() is a cached None.
+
+        Args:
+            key: cache key as str.
+            fn: function that computes object.
+            expires: cache time, default to 0 (using default expires time).
+            beta: how early to refresh, default to 1.0, larger value refreshes earlier.
+            lock_expires: seconds to wait for distributed lock, default to 0 (no lock). 
+                          The lock expires after it is rounded up to whole seconds.
+            missing_expires: cache time if fn() returns None, default to 0 (using expires).
+            bloom: BloomFilter of all existing keys, default to None. Return None for 
+                   key not in bloom without reading cache.
+
+        >>> c = LocalClient()
+        >>> calls = []
+        >>> def compute():
+        ...     calls.append(1)
+        ...     time.sleep(0.2)
+        ...     return 'Value'
+        >>> ts = [threading.Thread(target=c.get_or_compute, args=('key', compute, 60)) for i in range(10)]
+        >>> for t in ts: t.start()
+        >>> for t in ts: t.join()
+        >>> len(calls), c.get_or_compute('key', compute, 60)
+        (1, 'Value')
+        >>> c.get_or_compute('key', compute, 60, beta=float('inf'))
+        'Value'
+        >>> len(calls)
+        2
+        >>> c.add('key2:lock', 1, 1)
+        True
+        >>> c.get_or_compute('key2', compute, 60, lock_expires=0.5)
+        'Value'
+        >>> RedisClient('localhost:6379').get_or_compute(uuid.uuid4().hex, compute, 60, lock_expires=0.5)
+        'Value'
+        >>> c.get_or_compute('key3', lambda: None, 60, missing_expires=1)
+        >>> c.get_or_compute('key3', compute, 60, missing_expires=1)
+        >>> time.sleep(1.1)
+        >>> c.get_or_compute('key3', compute, 60, missing_expires=1)
+        'Value'
+        >>> b = BloomFilter(100)
+        >>> b.add('key4')
+        >>> c.get_or_compute('key5', compute, 60, bloom=b)
+        >>> c.set('key6', 'abc')
+        >>> c.sets({'key7': [1, 2], 'key8': ('x', 'y', 'z')})
+        >>> c.set_missing('key9', 60)
+        >>> n = len(calls)
+        >>> [c.get_or_compute(k, compute, 60, beta=float('inf')) for k in ('key6', 'key7', 'key8', 'key9')]
+        ['abc', [1, 2], ('x', 'y', 'z'), None]
+        >>> len(calls)==n
+        True
+        '''
+        if bloom is not None and not key in bloom:
+            return None
+        r = self.get(key)
+        if r is not None:
+            if not _is_xfetch(r):
+                return _computed(r)
+            value, delta, expiry = r[1:]
+            if not expiry or beta <= 0 or time.time() - delta * beta * math.log(1.0 - random.random()) < expiry:
+                return value
+            # refresh early by one caller, others get cached object:
+            return _single_flight((id(self), key), lambda: self._compute(key, fn, expires, lock_expires, missing_expires, r), False, value)
+        return _single_flight((id(self), key), lambda: self._compute(key, fn, expires, lock_expires, missing_expires, None))
+
+    def _compute(self, key, fn, expires, lock_expires, missing_expires, stale):
+        lock_key = None
+        if lock_expires:
+            deadline = time.time() + lock_expires
+            # redis rejects and memcache truncates fractional expires:
+            while not self.add('%s:lock' % key, 1, int(math.ceil(lock_expires))):
+                if stale is not None:
+                    return stale[1]
+                if time.time() > deadline:
+                    logging.warning('wait lock of cache key timeout: %s' % key)
+                    break
+                time.sleep(0.05)
+                r = self.get(key)
+                if r is not None:
+                    return _computed(r)
+            else:
+                lock_key = '%s:lock' % key
+        try:
+            start = time.time()
+            value = fn()
+            now = time.time()
+            if value is None and missing_expires:
+                expires = missing_expires
+            self.set(key, (_XFETCH, value, now - start, now + expires if expires else 0), expires)
+            return value
+        finally:
+            if lock_key:
+                self.delete(lock_key)
+
+class DummyClient(BaseClient):
+
+    def set(self, key, value, expires=0, tags=None):
+        pass
 
-    def set(self, key, value, expires=0):
+    def sets(self, mapping, expires=0, tags=None):
         pass
 
+    def add(self, key, value, expires=0):
+        return True
+
     def setint(self, key, value, expires=0):
         pass
 
@@ -28,6 +417,9 @@ class DummyClient(object):
     def gets(self, *keys):
         return [None] * len(keys)
 
+    def touch(self, key, expires):
+        pass
+
     def getint(self, key, default=0):
         return default
 
@@ -37,21 +429,55 @@ class DummyClient(object):
     def delete(self, key):
         pass
 
-    def incr(self, key):
+    def deletes(self, *keys):
         pass
 
-    def decr(self, key):
+    def incr(self, key, delta=1):
         pass
 
-class MemcacheClient(object):
+    def incrs(self, *keys):
+        return [None] * len(keys)
+
+    def incrs_by(self, mapping):
+        return dict([(k, None) for k in mapping])
+
+    def decr(self, key, delta=1):
+        pass
+
+class MemcacheClient(BaseClient):
+
+    def __init__(self, servers, debug=False, codec=None, timeout=1.0, dead_retry=30):
+        '''
+        Init MemcacheClient with servers. Values are pickled by memcache module, or 
+        encoded by codec if codec is set (ints are always stored as int for incr).
 
-    def __init__(self, servers, debug=False):
+        A server that fails or times out is marked dead and skipped (as cache miss) 
+        for dead_retry seconds.
+
+        Args:
+            servers: server as 'host:port' or list of servers.
+            debug: debug mode of memcache module, default to False.
+            codec: Codec of values, default to None (pickled by memcache module).
+            timeout: socket timeout in seconds, default to 1.0.
+            dead_retry: seconds before retrying a dead server, default to 30.
+        '''
         import memcache
         if isinstance(servers, basestring):
             servers = [servers]
-        self._client = memcache.Client(servers, debug)
+        self._client = memcache.Client(servers, debug, socket_timeout=timeout, dead_retry=dead_retry)
+        self._codec = codec
 
-    def set(self, key, value, expires=0):
+    def _encode(self, value):
+        if self._codec is None or isinstance(value, (int, long)):
+            return value
+        return self._codec.dumps(value)
+
+    def _decode(self, r):
+        if self._codec is None or not isinstance(r, str):
+            return r
+        return _safe_loads(self._codec, r)
+
+    def set(self, key, value, expires=0, tags=None):
         '''
         Set object with key.
 
@@ -59,6 +485,7 @@ class MemcacheClient(object):
             key: cache key as str.
             value: object value.
             expires: cache time, default to 0 (using default expires time)
+            tags: list of tags, default to None. See invalidate_tag().
 
         >>> key = uuid.uuid4().hex
         >>> c = MemcacheClient('localhost:11211')
@@ -75,10 +502,58 @@ class MemcacheClient(object):
         >>> c.get(key, 'Not Exist')
         'Not Exist'
         '''
-        self._client.set(key, value, expires)
+        if tags:
+            value = self._tag(value, self._tag_versions(tags))
+        self._client.set(key, self._encode(value), expires)
 
     setint = set
 
+    def sets(self, mapping, expires=0, tags=None):
+        '''
+        Set objects by dict of key-value in one request.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = MemcacheClient('localhost:11211')
+        >>> c.sets({key1: 'Key1', key2: 'Key2'})
+        >>> c.gets(key1, key2)
+        ['Key1', 'Key2']
+        '''
+        if tags:
+            versions = self._tag_versions(tags)
+            mapping = dict([(k, self._tag(v, versions)) for k, v in mapping.iteritems()])
+        self._client.set_multi(dict([(k, self._encode(v)) for k, v in mapping.iteritems()]), expires)
+
+    def add(self, key, value, expires=0):
+        '''
+        Set object only if key does not exist. Return True if set.
+
+        >>> key = uuid.uuid4().hex
+        >>> c = MemcacheClient('localhost:11211')
+        >>> c.add(key, 'Added')
+        True
+        >>> c.add(key, 'Again')
+        False
+        >>> c.get(key)
+        'Added'
+        '''
+        return bool(self._client.add(key, self._encode(value), expires))
+
+    def touch(self, key, expires):
+        '''
+        Set expires of key to expires seconds from now. Memcache cannot read expire 
+        time, so it is set even if key never expires or expires later.
+
+        >>> key = uuid.uuid4().hex
+        >>> c = MemcacheClient('localhost:11211')
+        >>> c.set(key, 'Touched', 1)
+        >>> c.touch(key, 60)
+        >>> time.sleep(1.1)
+        >>> c.get(key)
+        'Touched'
+        '''
+        self._client.touch(key, expires)
+
     def get(self, key, default=None):
         '''
         Get object by key.
@@ -98,7 +573,9 @@ class MemcacheClient(object):
         >>> c.get(key)
         'hello, mc'
         '''
-        r = self._client.get(key)
+        r = self._decode(self._client.get(key))
+        if _is_tagged(r):
+            r = self._untag([r])[0]
         return default if r is None else r
 
     def getint(self, key, default=0):
@@ -137,7 +614,7 @@ class MemcacheClient(object):
         ['Key1', None, 'Key3']
         '''
         r = self._client.get_multi(keys)
-        return map(lambda k: r.get(k), keys)
+        return self._untag(map(lambda k: self._decode(r.get(k)), keys))
 
     def getints(self, *keys):
         '''
@@ -174,12 +651,27 @@ class MemcacheClient(object):
         '''
         self._client.delete(key)
 
-    def incr(self, key):
+    def deletes(self, *keys):
+        '''
+        Delete objects by keys in one request.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = MemcacheClient('localhost:11211')
+        >>> c.sets({key1: 'Key1', key2: 'Key2'})
+        >>> c.deletes(key1, key2)
+        >>> c.gets(key1, key2)
+        [None, None]
+        '''
+        self._client.delete_multi(keys)
+
+    def incr(self, key, delta=1):
         '''
         Increase counter.
 
         Args:
             key: cache key as str.
+            delta: delta to increase, default to 1.
 
         >>> key = uuid.uuid4().hex
         >>> c = MemcacheClient('localhost:11211')
@@ -190,20 +682,52 @@ class MemcacheClient(object):
         >>> c.set(key, 100)
         >>> c.incr(key)
         101
+        >>> c.incr(key, 10)
+        111
         '''
-        r = self._client.incr(key)
+        r = self._client.incr(key, delta)
         if r is None:
-            self._client.set(key, 1)
-            r = 1
+            self._client.set(key, delta)
+            r = delta
         return r
 
-    def decr(self, key):
+    def incrs(self, *keys):
+        '''
+        Increase counters and return list of values. NOTE memcache has no multi-incr 
+        so each key costs one request.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = MemcacheClient('localhost:11211')
+        >>> c.incr(key1)
+        1
+        >>> c.incrs(key1, key2)
+        [2, 1]
+        '''
+        return map(self.incr, keys)
+
+    def incrs_by(self, mapping):
+        '''
+        Increase counters by dict of key-delta and return dict of key-value. Negative 
+        delta is sent as decr.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = MemcacheClient('localhost:11211')
+        >>> c.setint(key2, 10)
+        >>> sorted(c.incrs_by({key1: 5, key2: -3}).values())
+        [5, 7]
+        '''
+        return dict([(k, self.incr(k, d) if d >= 0 else self.decr(k, -d)) for k, d in mapping.iteritems()])
+
+    def decr(self, key, delta=1):
         '''
         Decrease counter. NOTE the memcache does not allow negative number, 
         so decr key = 0 will still return 0
 
         Args:
             key: cache key as str.
+            delta: delta to decrease, default to 1.
 
         >>> key = uuid.uuid4().hex
         >>> c = MemcacheClient('localhost:11211')
@@ -215,19 +739,19 @@ class MemcacheClient(object):
         >>> c.decr(key)
         99
         '''
-        r = self._client.decr(key)
+        r = self._client.decr(key, delta)
         if r is None:
             self._client.set(key, 0)
             r = 0
         return r
 
-def _safe_pickle_loads(r):
+def _safe_loads(codec, r):
     if r is None:
         return None
     try:
-        return pickle.loads(r)
-    except pickle.UnpicklingError:
-        pass
+        return codec.loads(r)
+    except Exception, e:
+        logging.warning('decode cache value failed: %s' % e)
     return None
 
 def _safe_int(r, default=0):
@@ -238,16 +762,133 @@ def _safe_int(r, default=0):
     except ValueError:
         return default
 
-class RedisClient(object):
+class _HashRing(object):
+    '''
+    Consistent hash ring that maps key to node by virtual nodes.
+
+    >>> r = _HashRing(['a', 'b', 'c'])
+    >>> keys = ['key-%s' % i for i in range(3000)]
+    >>> nodes = [r.node(k) for k in keys]
+    >>> sorted([(n, nodes.count(n) > 800) for n in set(nodes)])
+    [('a', True), ('b', True), ('c', True)]
+    >>> r2 = _HashRing(['a', 'b', 'c', 'd'])
+    >>> moved = [k for k, n in zip(keys, nodes) if r2.node(k)!=n]
+    >>> len(moved) < 1000 and all([r2.node(k)=='d' for k in moved])
+    True
+    '''
+    def __init__(self, nodes, replicas=160):
+        points = []
+        for node in nodes:
+            for i in range(replicas):
+                points.append((self._hash('%s#%s' % (node, i)), node))
+        points.sort()
+        self._points = [p[0] for p in points]
+        self._nodes = [p[1] for p in points]
+
+    def _hash(self, key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def node(self, key):
+        n = bisect.bisect(self._points, self._hash(key))
+        return self._nodes[0 if n==len(self._nodes) else n]
+
+class RedisClient(BaseClient):
+
+    def __init__(self, servers, debug=False, codec=None, max_connections=50, connect_timeout=0.5, timeout=1.0):
+        '''
+        Init RedisClient with server as 'host' or 'host:port', or list of servers 
+        that keys are distributed to by consistent hashing. Values are encoded by 
+        codec, default to Codec() (pickle, zlib if larger than 1K).
+
+        Errors are raised, so wrap it by BreakerClient to fall back as cache miss 
+        when server is down or slow.
 
-    def __init__(self, servers, debug=False):
+        Args:
+            servers: server as 'host[:port]' or list of servers.
+            debug: not used.
+            codec: Codec of values, default to None (using Codec()).
+            max_connections: connection pool size of each server, default to 50.
+            connect_timeout: seconds to connect or to wait for a pooled connection, 
+                             default to 0.5.
+            timeout: socket read and write timeout in seconds, default to 1.0.
+        '''
         import redis
-        self._client = redis.StrictRedis(host=servers)
+        self._codec = codec or Codec()
+        if isinstance(servers, basestring):
+            servers = [servers]
+        self._clients = dict()
+        for server in servers:
+            host, port = server.split(':', 1) if ':' in server else (server, 6379)
+            pool = redis.BlockingConnectionPool(host=host, port=int(port), \
+                max_connections=max_connections, timeout=connect_timeout, \
+                socket_connect_timeout=connect_timeout, socket_timeout=timeout)
+            self._clients[server] = redis.StrictRedis(connection_pool=pool)
+        self._client = self._clients[servers[0]]
+        self._ring = _HashRing(servers) if len(servers) > 1 else None
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def _node(self, key):
+        return self._clients[self._ring.node(key)] if self._ring else self._client
+
+    def _map_nodes(self, keys, fn):
+        '''
+        Call fn(client, keys) for keys of each node in parallel and return the merged 
+        list of results in the order of keys.
+        '''
+        if not self._ring:
+            return fn(self._client, keys)
+        groups = dict()
+        for i, key in enumerate(keys):
+            groups.setdefault(self._ring.node(key), []).append(i)
+        if len(groups)==1:
+            return fn(self._clients[groups.keys()[0]], keys)
+        pool = self._thread_pool()
+        def _call(group):
+            return fn(self._clients[group[0]], [keys[i] for i in group[1]])
+        groups = groups.items()
+        rs = [None] * len(keys)
+        for (node, indexes), values in zip(groups, pool.map(_call, groups)):
+            for i, v in zip(indexes, values):
+                rs[i] = v
+        return rs
+
+    def _thread_pool(self):
+        '''
+        Return thread pool of this process. Threads of pool do not exist after fork, 
+        so the pool is created again in child process.
+
+        >>> servers = [cacheserver.RedisServer().start() for i in range(2)]
+        >>> c = RedisClient([s.address for s in servers])
+        >>> keys = ['key%d' % i for i in range(10)]
+        >>> c.sets(dict(zip(keys, keys)))
+        >>> c.gets(*keys)==keys
+        True
+        >>> pid = os.fork()
+        >>> if pid==0:
+        ...     signal.alarm(5)
+        ...     os._exit(0 if c.gets(*keys)==keys else 1)
+        >>> os.waitpid(pid, 0)[1]
+        0
+        >>> for s in servers: s.stop()
+        '''
+        pid = os.getpid()
+        if self._pool_pid!=pid:
+            with self._pool_lock:
+                if self._pool_pid!=pid:
+                    from multiprocessing.pool import ThreadPool
+                    self._pool = ThreadPool(len(self._clients))
+                    self._pool_pid = pid
+        return self._pool
+
+    def _mget(self, keys):
+        return self._map_nodes(keys, lambda c, ks: c.mget(ks))
 
     def setint(self, key, value, expires=0):
-        self._set(key, value, expires, use_pickle=False)
+        self._set(key, value, expires, encode=False)
 
-    def set(self, key, value, expires=0):
+    def set(self, key, value, expires=0, tags=None):
         '''
         Set object with key.
 
@@ -255,6 +896,7 @@ class RedisClient(object):
             key: cache key as str.
             value: object value.
             expires: cache time, default to 0 (using default expires time)
+            tags: list of tags, default to None. See invalidate_tag().
 
         >>> key = uuid.uuid4().hex
         >>> c = RedisClient('localhost')
@@ -272,12 +914,69 @@ class RedisClient(object):
         'Not Exist'
         '''
         logging.debug('set cache: key = %s' % key)
-        self._set(key, value, expires, use_pickle=True)
+        if tags:
+            value = self._tag(value, self._tag_versions(tags))
+        self._set(key, value, expires, encode=True)
+
+    def _set(self, key, value, expires, encode):
+        self._node(key).set(key, self._codec.dumps(value) if encode else value, ex=expires or None)
 
-    def _set(self, key, value, expires, use_pickle):
-        self._client.set(key, pickle.dumps(value) if use_pickle else value)
-        if expires:
-            self._client.expire(key, expires)
+    def touch(self, key, expires):
+        '''
+        Extend expires of key to expires seconds from now. Key that never expires 
+        or expires later is not changed.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = RedisClient('localhost')
+        >>> c.set(key1, 'Touched', 1)
+        >>> c.set(key2, 'Forever')
+        >>> c.touch(key1, 60), c.touch(key2, 1)
+        (None, None)
+        >>> time.sleep(1.1)
+        >>> c.gets(key1, key2)
+        ['Touched', 'Forever']
+        '''
+        c = self._node(key)
+        ttl = c.ttl(key)
+        if ttl is not None and 0 <= ttl < expires:
+            c.expire(key, int(math.ceil(expires)))
+
+    def sets(self, mapping, expires=0, tags=None):
+        '''
+        Set objects by dict of key-value in one pipeline per node.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = RedisClient('localhost')
+        >>> c.sets({key1: 'Key1', key2: ['Key', 2]}, 60)
+        >>> c.gets(key1, key2)
+        ['Key1', ['Key', 2]]
+        '''
+        if tags:
+            versions = self._tag_versions(tags)
+            mapping = dict([(k, self._tag(v, versions)) for k, v in mapping.iteritems()])
+        def _sets(c, keys):
+            p = c.pipeline(transaction=False)
+            for key in keys:
+                p.set(key, self._codec.dumps(mapping[key]), ex=expires or None)
+            return p.execute()
+        self._map_nodes(mapping.keys(), _sets)
+
+    def add(self, key, value, expires=0):
+        '''
+        Set object only if key does not exist. Return True if set.
+
+        >>> key = uuid.uuid4().hex
+        >>> c = RedisClient('localhost')
+        >>> c.add(key, 'Added')
+        True
+        >>> c.add(key, 'Again')
+        False
+        >>> c.get(key)
+        'Added'
+        '''
+        return bool(self._node(key).set(key, self._codec.dumps(value), nx=True, ex=expires or None))
 
     def get(self, key, default=None):
         '''
@@ -302,10 +1001,10 @@ class RedisClient(object):
         12345
         '''
         logging.debug('get cache: key = %s' % key)
-        r = self._client.get(key)
-        if r is None:
-            return default
-        return _safe_pickle_loads(r)
+        r = _safe_loads(self._codec, self._node(key).get(key))
+        if _is_tagged(r):
+            r = self._untag([r])[0]
+        return default if r is None else r
 
     def gets(self, *keys):
         '''
@@ -327,7 +1026,7 @@ class RedisClient(object):
         >>> c.gets(key1, key2, key3)
         ['Key1', None, 'Key3']
         '''
-        return map(_safe_pickle_loads, self._client.mget(keys))
+        return self._untag(map(lambda r: _safe_loads(self._codec, r), self._mget(keys)))
 
     def delete(self, key):
         '''
@@ -344,7 +1043,22 @@ class RedisClient(object):
         >>> c.delete(key)
         >>> c.get(key)
         '''
-        self._client.delete(key)
+        self._node(key).delete(key)
+
+    def deletes(self, *keys):
+        '''
+        Delete objects by keys in one request per node.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = RedisClient('localhost')
+        >>> c.sets({key1: 'Key1', key2: 'Key2'})
+        >>> c.deletes(key1, key2)
+        >>> c.gets(key1, key2)
+        [None, None]
+        '''
+        if keys:
+            self._map_nodes(keys, lambda c, ks: [c.delete(*ks)] * len(ks))
 
     def getints(self, *keys):
         '''
@@ -363,17 +1077,18 @@ class RedisClient(object):
         >>> c.getints(key1, key2, key3)
         [100, -200, 1]
         '''
-        return map(_safe_int, self._client.mget(keys))
+        return map(_safe_int, self._mget(keys))
 
     def getint(self, key, default=0):
-        return _safe_int(self._client.get(key), default)
+        return _safe_int(self._node(key).get(key), default)
 
-    def incr(self, key):
+    def incr(self, key, delta=1):
         '''
         Increase counter.
 
         Args:
             key: cache key as str.
+            delta: delta to increase, default to 1.
 
         >>> key = uuid.uuid4().hex
         >>> c = RedisClient('localhost')
@@ -389,14 +1104,54 @@ class RedisClient(object):
         >>> c.getint(key + '-no', 10)
         10
         '''
-        return self._client.incr(key)
+        return self._node(key).incr(key, delta)
 
-    def decr(self, key):
+    def incrs(self, *keys):
+        '''
+        Increase counters in one pipeline per node and return list of values.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = RedisClient('localhost')
+        >>> c.incr(key1)
+        1
+        >>> c.incrs(key1, key2)
+        [2, 1]
+        '''
+        def _incrs(c, keys):
+            p = c.pipeline(transaction=False)
+            for key in keys:
+                p.incr(key)
+            return p.execute()
+        return self._map_nodes(keys, _incrs)
+
+    def incrs_by(self, mapping):
+        '''
+        Increase counters by dict of key-delta in one pipeline of INCRBY per node, 
+        and return dict of key-value.
+
+        >>> key1 = uuid.uuid4().hex
+        >>> key2 = uuid.uuid4().hex
+        >>> c = RedisClient('localhost')
+        >>> c.setint(key2, 10)
+        >>> sorted(c.incrs_by({key1: 5, key2: -3}).values())
+        [5, 7]
+        '''
+        def _incrs_by(c, keys):
+            p = c.pipeline(transaction=False)
+            for key in keys:
+                p.incr(key, mapping[key])
+            return p.execute()
+        keys = mapping.keys()
+        return dict(zip(keys, self._map_nodes(keys, _incrs_by)))
+
+    def decr(self, key, delta=1):
         '''
         Decrease counter.
 
         Args:
             key: cache key as str.
+            delta: delta to decrease, default to 1.
 
         >>> key = uuid.uuid4().hex
         >>> c = RedisClient('localhost')
@@ -405,13 +1160,1974 @@ class RedisClient(object):
         >>> c.decr(key)
         -2
         >>> c.setint(key, 100)
-        >>> c.decr(key)
-        99
+        >>> c.decr(key), c.decr(key, 10)
+        (99, 89)
+        '''
+        return self._node(key).decr(key, delta)
+
+    def publish(self, channel, message):
+        '''
+        Publish message to channel.
+        '''
+        self._client.publish(channel, message)
+
+    def subscribe(self, channel, callback):
+        '''
+        Start a daemon thread that calls callback(message) for each message of channel.
+        '''
+        def _listen():
+            while True:
+                try:
+                    p = self._client.pubsub()
+                    p.subscribe(channel)
+                    while True:
+                        # poll instead of listen() that breaks by socket timeout when idle:
+                        msg = p.get_message(timeout=60)
+                        if msg and msg['type']=='message':
+                            callback(msg['data'])
+                except Exception:
+                    logging.exception('subscribe channel %s failed. retry after 1 sec...' % channel)
+                    time.sleep(1)
+        t = threading.Thread(target=_listen, name='redis-subscribe-%s' % channel)
+        t.daemon = True
+        t.start()
+        return t
+
+class _LocalSegment(object):
+    '''
+    LRU segment of LocalClient that holds key -> (data, expires) guarded by its own lock.
+    '''
+    def __init__(self, max_entries, max_bytes):
+        self.lock = threading.Lock()
+        self.data = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+    def get(self, key, now):
+        '''
+        Get data by key and mark it as recently used. Must hold lock.
+        '''
+        entry = self.data.pop(key, None)
+        if entry is None:
+            return None
+        if entry[1] and entry[1] <= now:
+            self.bytes = self.bytes - len(key) - len(entry[0])
+            return None
+        self.data[key] = entry
+        return entry[0]
+
+    def put(self, key, data, expires):
+        '''
+        Put data and evict least recently used entries if full. Must hold lock.
+        '''
+        self.remove(key)
+        self.data[key] = (data, expires)
+        self.bytes = self.bytes + len(key) + len(data)
+        while len(self.data) > self.max_entries or (self.bytes > self.max_bytes and len(self.data) > 1):
+            k, entry = self.data.popitem(last=False)
+            self.bytes = self.bytes - len(k) - len(entry[0])
+
+    def remove(self, key):
+        '''
+        Remove data by key. Must hold lock.
+        '''
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.bytes = self.bytes - len(key) - len(entry[0])
+        return entry
+
+class LocalClient(BaseClient):
+    '''
+    In-process cache client with LRU eviction and per-key expires. Values are 
+    stored as str encoded by codec so cached objects are not shared with callers.
+
+    Keys are spread over segments that each has its own lock and LRU list, and 
+    max_entries and max_bytes are divided between segments.
+
+    >>> c = LocalClient(max_entries=4, segments=1)
+    >>> for i in range(5):
+    ...     c.set('k%s' % i, i)
+    >>> c.gets('k0', 'k1', 'k4')
+    [None, 1, 4]
+    >>> c.get('k1')
+    1
+    >>> c.set('k5', 5)
+    >>> c.gets('k1', 'k2')
+    [1, None]
+    >>> c.set('t', 'Expires after 1 sec', 1)
+    >>> c.get('t')
+    'Expires after 1 sec'
+    >>> time.sleep(1.1)
+    >>> c.get('t', 'Not Exist')
+    'Not Exist'
+    >>> L = [1, 2]
+    >>> c.set('list', L)
+    >>> L.append(3)
+    >>> c.get('list')
+    [1, 2]
+    >>> c = LocalClient(max_bytes=100, segments=1)
+    >>> c.set('a', 'x' * 60)
+    >>> c.set('b', 'y' * 60)
+    >>> c.get('a'), len(c.get('b'))
+    (None, 60)
+    '''
+    def __init__(self, max_entries=10000, max_bytes=64*1024*1024, segments=16, codec=None):
+        '''
+        Init LocalClient.
+
+        Args:
+            max_entries: max number of entries, default to 10000.
+            max_bytes: max bytes of keys and encoded values, default to 64M.
+            segments: number of segments, default to 16.
+            codec: codec of values, default to Codec(compressor=None).
+        '''
+        self._codec = codec or Codec(compressor=None)
+        self._segments = [_LocalSegment(max(1, max_entries // segments), max(1, max_bytes // segments)) for i in range(segments)]
+
+    def _segment(self, key):
+        return self._segments[hash(key) % len(self._segments)]
+
+    def set(self, key, value, expires=0, tags=None):
+        '''
+        Set object with key.
+
+        Args:
+            key: cache key as str.
+            value: object value.
+            expires: cache time in seconds, default to 0 (never expires).
+            tags: list of tags, default to None. See invalidate_tag().
+        '''
+        if tags:
+            value = self._tag(value, self._tag_versions(tags))
+        data = self._codec.dumps(value)
+        seg = self._segment(key)
+        with seg.lock:
+            seg.put(key, data, time.time() + expires if expires else 0)
+
+    setint = set
+
+    def sets(self, mapping, expires=0, tags=None):
+        '''
+        Set objects by dict of key-value.
+
+        >>> c = LocalClient()
+        >>> c.sets({'key1': 'Key1', 'key2': 'Key2'})
+        >>> c.gets('key1', 'key2')
+        ['Key1', 'Key2']
+        '''
+        versions = self._tag_versions(tags) if tags else None
+        for k, v in mapping.iteritems():
+            self.set(k, self._tag(v, versions) if tags else v, expires)
+
+    def add(self, key, value, expires=0):
+        '''
+        Set object only if key does not exist. Return True if set.
+
+        >>> c = LocalClient()
+        >>> c.add('key', 'Added'), c.add('key', 'Again'), c.get('key')
+        (True, False, 'Added')
+        '''
+        data = self._codec.dumps(value)
+        seg = self._segment(key)
+        now = time.time()
+        with seg.lock:
+            if seg.get(key, now) is not None:
+                return False
+            seg.put(key, data, now + expires if expires else 0)
+            return True
+
+    def touch(self, key, expires):
+        '''
+        Extend expires of key to expires seconds from now. Key that never expires 
+        or expires later is not changed.
+
+        >>> c = LocalClient()
+        >>> c.set('key1', 'Touched', 1)
+        >>> c.set('key2', 'Forever')
+        >>> c.touch('key1', 60)
+        >>> c.touch('key2', 1)
+        >>> time.sleep(1.1)
+        >>> c.gets('key1', 'key2')
+        ['Touched', 'Forever']
+        '''
+        seg = self._segment(key)
+        now = time.time()
+        with seg.lock:
+            entry = seg.data.get(key)
+            if entry is not None and now < entry[1] < now + expires:
+                seg.data[key] = (entry[0], now + expires)
+
+    def _get(self, key, now):
+        seg = self._segment(key)
+        with seg.lock:
+            return seg.get(key, now)
+
+    def get(self, key, default=None):
+        '''
+        Get object by key.
+
+        >>> c = LocalClient()
+        >>> c.get('not-exist')
+        >>> c.get('not-exist', 'DEFAULT_LOCAL')
+        'DEFAULT_LOCAL'
+        >>> c.set('key', u'hello, local')
+        >>> c.get('key')
+        u'hello, local'
+        '''
+        r = self._get(key, time.time())
+        if r is None:
+            return default
+        r = self._codec.loads(r)
+        if _is_tagged(r):
+            r = self._untag([r])[0]
+        return default if r is None else r
+
+    def gets(self, *keys):
+        '''
+        Get objects by keys.
+
+        >>> c = LocalClient()
+        >>> c.set('key1', 'Key1')
+        >>> c.set('key3', 'Key3')
+        >>> c.gets('key1', 'key2', 'key3')
+        ['Key1', None, 'Key3']
+        '''
+        now = time.time()
+        return self._untag(map(lambda k: _safe_loads(self._codec, self._get(k, now)), keys))
+
+    def getint(self, key, default=0):
+        '''
+        Get int.
+
+        >>> c = LocalClient()
+        >>> c.getint('key')
+        0
+        >>> c.setint('key', 101)
+        >>> c.getint('key')
+        101
+        '''
+        return _safe_int(self.get(key), default)
+
+    def getints(self, *keys):
+        '''
+        Get ints by keys.
+
+        >>> c = LocalClient()
+        >>> c.setint('key1', 11)
+        >>> c.setint('key3', -99)
+        >>> c.getints('key1', 'key2', 'key3')
+        [11, 0, -99]
+        '''
+        return map(_safe_int, self.gets(*keys))
+
+    def delete(self, key):
+        '''
+        Delete object from cache by key.
+
+        >>> c = LocalClient()
+        >>> c.set('key', 'delete from local')
+        >>> c.delete('key')
+        >>> c.get('key')
+        '''
+        seg = self._segment(key)
+        with seg.lock:
+            seg.remove(key)
+
+    def deletes(self, *keys):
+        '''
+        Delete objects by keys.
+
+        >>> c = LocalClient()
+        >>> c.sets({'key1': 'Key1', 'key2': 'Key2'})
+        >>> c.deletes('key1', 'key2')
+        >>> c.gets('key1', 'key2')
+        [None, None]
+        '''
+        for key in keys:
+            self.delete(key)
+
+    def _incr(self, key, delta):
+        seg = self._segment(key)
+        with seg.lock:
+            entry = seg.remove(key)
+            if entry is None or (entry[1] and entry[1] <= time.time()):
+                r, expires = delta, 0
+            else:
+                r, expires = _safe_int(_safe_loads(self._codec, entry[0])) + delta, entry[1]
+            seg.put(key, self._codec.dumps(r), expires)
+            return r
+
+    def incr(self, key, delta=1):
+        '''
+        Increase counter.
+
+        >>> c = LocalClient()
+        >>> c.incr('key')
+        1
+        >>> c.incr('key')
+        2
+        >>> c.set('key', 100)
+        >>> c.incr('key', 10)
+        110
+        '''
+        return self._incr(key, delta)
+
+    def incrs(self, *keys):
+        '''
+        Increase counters and return list of values.
+
+        >>> c = LocalClient()
+        >>> c.incr('key1')
+        1
+        >>> c.incrs('key1', 'key2')
+        [2, 1]
+        '''
+        return [self._incr(key, 1) for key in keys]
+
+    def incrs_by(self, mapping):
+        '''
+        Increase counters by dict of key-delta and return dict of key-value.
+
+        >>> c = LocalClient()
+        >>> c.incrs_by({'key1': 5, 'key2': -3})
+        {'key2': -3, 'key1': 5}
+        '''
+        return dict([(k, self._incr(k, d)) for k, d in mapping.iteritems()])
+
+    def decr(self, key, delta=1):
+        '''
+        Decrease counter.
+
+        >>> c = LocalClient()
+        >>> c.decr('key')
+        -1
+        >>> c.set('key', 100)
+        >>> c.decr('key'), c.decr('key', 10)
+        (99, 89)
+        '''
+        return self._incr(key, -delta)
+
+class TieredClient(BaseClient):
+    '''
+    Two-tier cache client that keeps a short-lived local copy in front of a remote 
+    client (MemcacheClient or RedisClient). Reads check local tier first, writes 
+    and deletes go through both tiers. Counters (setint/getint/incr/decr) are 
+    always read from remote tier.
+
+    If channel is set and remote is RedisClient, sets and deletes are published 
+    to channel so other processes drop their local copies.
+
+    >>> remote = LocalClient()
+    >>> c = TieredClient(remote, local_expires=1)
+    >>> c.set('key', 'Value')
+    >>> remote.delete('key')
+    >>> c.get('key')
+    'Value'
+    >>> time.sleep(1.1)
+    >>> c.get('key', 'Expired')
+    'Expired'
+    >>> remote.set('key1', 'Key1')
+    >>> c.set('key3', 'Key3')
+    >>> c.gets('key1', 'key2', 'key3')
+    ['Key1', None, 'Key3']
+    >>> c.delete('key3')
+    >>> c.gets('key1', 'key2', 'key3')
+    ['Key1', None, None]
+    >>> c.incr('counter'), c.incr('counter'), c.getint('counter')
+    (1, 2, 2)
+    '''
+    def __init__(self, remote, local=None, local_expires=5, channel=None):
+        '''
+        Init TieredClient.
+
+        Args:
+            remote: remote cache client.
+            local: local cache client, default to LocalClient(max_entries=1000).
+            local_expires: max seconds of local copy, default to 5.
+            channel: channel name for publishing invalidations, default to None.
+        '''
+        self._remote = remote
+        self._local = LocalClient(max_entries=1000) if local is None else local
+        self._local_expires = local_expires
+        self._channel = channel
+        self._token = uuid.uuid4().hex
+        if channel:
+            if not hasattr(remote, 'subscribe'):
+                raise ValueError('remote client does not support channel.')
+            remote.subscribe(channel, self._on_invalidate)
+
+    def _on_invalidate(self, message):
+        token, key = message.split(':', 1)
+        if token!=self._token:
+            self._local.delete(key)
+
+    def _invalidate(self, key):
+        if self._channel:
+            self._remote.publish(self._channel, '%s:%s' % (self._token, key))
+
+    def _local_set(self, key, value, expires=0):
+        self._local.set(key, value, min(expires, self._local_expires) if expires else self._local_expires)
+
+    def set(self, key, value, expires=0, tags=None):
+        self._remote.set(key, value, expires, tags)
+        self._local_set(key, value, expires)
+        self._invalidate(key)
+
+    def sets(self, mapping, expires=0, tags=None):
+        self._remote.sets(mapping, expires, tags)
+        for k, v in mapping.iteritems():
+            self._local_set(k, v, expires)
+            self._invalidate(k)
+
+    def add(self, key, value, expires=0):
+        r = self._remote.add(key, value, expires)
+        if r:
+            self._local_set(key, value, expires)
+        return r
+
+    def touch(self, key, expires):
+        self._remote.touch(key, expires)
+
+    def setint(self, key, value, expires=0):
+        self._remote.setint(key, value, expires)
+        self._local.delete(key)
+        self._invalidate(key)
+
+    def get(self, key, default=None):
+        r = self._local.get(key)
+        if r is None:
+            r = self._remote.get(key)
+            if r is None:
+                return default
+            self._local_set(key, r)
+        return r
+
+    def gets(self, *keys):
+        L = self._local.gets(*keys)
+        missing = [i for i, r in enumerate(L) if r is None]
+        if missing:
+            R = self._remote.gets(*[keys[i] for i in missing])
+            for i, r in zip(missing, R):
+                if r is not None:
+                    L[i] = r
+                    self._local_set(keys[i], r)
+        return L
+
+    def getint(self, key, default=0):
+        return self._remote.getint(key, default)
+
+    def getints(self, *keys):
+        return self._remote.getints(*keys)
+
+    def delete(self, key):
+        self._remote.delete(key)
+        self._local.delete(key)
+        self._invalidate(key)
+
+    def deletes(self, *keys):
+        self._remote.deletes(*keys)
+        self._local.deletes(*keys)
+        for key in keys:
+            self._invalidate(key)
+
+    def incr(self, key, delta=1):
+        r = self._remote.incr(key, delta)
+        self._local.delete(key)
+        return r
+
+    def incrs(self, *keys):
+        L = self._remote.incrs(*keys)
+        self._local.deletes(*keys)
+        return L
+
+    def incrs_by(self, mapping):
+        r = self._remote.incrs_by(mapping)
+        self._local.deletes(*mapping.keys())
+        return r
+
+    def decr(self, key, delta=1):
+        r = self._remote.decr(key, delta)
+        self._local.delete(key)
+        return r
+
+_SHM_MAGIC = 'TWSHM002'
+# header: magic, slots, slabs, slab size, head of free slabs, clock hand of eviction, deleted slots:
+_SHM_HEADER = struct.Struct('<8sIIIIII')
+_SHM_HEADER_SIZE = 64
+# slot: state, slab, length, hash of key, expires:
+_SHM_SLOT = struct.Struct('<B3xIIQd4x')
+_SHM_KEY_LEN = struct.Struct('<H')
+_SHM_NEXT = struct.Struct('<I')
+_SHM_NONE = 0xffffffff
+_SLOT_EMPTY, _SLOT_USED, _SLOT_DELETED = 0, 1, 2
+
+class MmapClient(BaseClient):
+    '''
+    Cache client backed by a memory-mapped file that is shared by all processes 
+    on the host. The file holds a fixed-size open-addressing hash table and values 
+    in fixed-size slabs. Reads take a shared lock and writes an exclusive lock of 
+    the file (flock), and an evicted entry is picked by clock hand when no free 
+    slab left. Values larger than a slab are not cached. The hash table is rebuilt 
+    when deleted slots reach half of the slots that slabs never use, so probing 
+    always stops at an empty slot.
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'cache.mmap')
+    >>> c = MmapClient(path, slots=64, slabs=16, slab_size=256)
+    >>> c.set('key1', u'Python\u4e2d\u6587')
+    >>> c.gets('key1', 'key2')
+    [u'Python\u4e2d\u6587', None]
+    >>> c.incr('counter'), c.incr('counter', 10), c.decr('counter')
+    (1, 11, 10)
+    >>> c.set('t', 'Expires after 1 sec', 1)
+    >>> c.get('t')
+    'Expires after 1 sec'
+    >>> time.sleep(1.1)
+    >>> c.get('t', 'Not Exist')
+    'Not Exist'
+    >>> c.set('big', 'x' * 1000)
+    >>> c.get('big')
+    >>> for i in range(100):
+    ...     c.set('k%s' % i, i)
+    >>> len([x for x in c.gets(*['k%s' % i for i in range(100)]) if x is not None])
+    16
+    >>> pid = os.fork()
+    >>> if pid==0:
+    ...     MmapClient(path, slots=64, slabs=16, slab_size=256).set('from-child', 'Hello')
+    ...     os._exit(0)
+    >>> r = os.waitpid(pid, 0)
+    >>> c.get('from-child')
+    'Hello'
+    >>> c.delete('from-child')
+    >>> c.get('from-child')
+    >>> for i in range(5000):
+    ...     c.set('churn%d' % i, i)
+    ...     if i % 2:
+    ...         c.delete('churn%d' % (i - 1))
+    >>> c.get('churn4999'), c.get('churn4998')
+    (4999, None)
+    >>> len([i for i in range(64) if c._slot(i)[0]==_SLOT_EMPTY]) >= (64 - 16) // 2
+    True
+    >>> c.set('touched', 'Touched', 1)
+    >>> c.set('forever', 'Forever')
+    >>> c.touch('touched', 60)
+    >>> c.touch('forever', 1)
+    >>> time.sleep(1.1)
+    >>> c.gets('touched', 'forever')
+    ['Touched', 'Forever']
+    >>> os.remove(path)
+    '''
+    def __init__(self, path, slots=16384, slabs=4096, slab_size=4096, codec=None):
+        '''
+        Init MmapClient. The file is created if not exist, or re-initialized if it 
+        was created with different size.
+
+        Args:
+            path: path of the memory-mapped file.
+            slots: slots of hash table, must be more than slabs, default to 16384.
+            slabs: number of slabs, default to 4096.
+            slab_size: bytes of each slab that holds key and value, default to 4096.
+            codec: codec of values, default to Codec(compressor=None).
+        '''
+        if slots <= slabs:
+            raise ValueError('slots must be more than slabs.')
+        self._path = path
+        self._slots = slots
+        self._slabs = slabs
+        self._slab_size = slab_size
+        self._slab_offset = _SHM_HEADER_SIZE + _SHM_SLOT.size * slots
+        self._size = self._slab_offset + slab_size * slabs
+        self._max_deleted = max(1, (slots - slabs) // 2)
+        self._codec = codec or Codec(compressor=None)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._open()
+
+    def _open(self):
+        import fcntl, mmap
+        self._fcntl = fcntl
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size!=self._size:
+                os.ftruncate(fd, self._size)
+            mm = mmap.mmap(fd, self._size)
+            magic, slots, slabs, slab_size, free, clock, deleted = _SHM_HEADER.unpack_from(mm, 0)
+            if (magic, slots, slabs, slab_size)!=(_SHM_MAGIC, self._slots, self._slabs, self._slab_size):
+                self._init(mm)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._mm = mm
+        self._pid = os.getpid()
+
+    def _init(self, mm):
+        logging.info('init mmap cache file: %s' % self._path)
+        mm[_SHM_HEADER_SIZE:self._slab_offset] = '\0' * (self._slab_offset - _SHM_HEADER_SIZE)
+        for i in xrange(self._slabs):
+            _SHM_NEXT.pack_into(mm, self._slab_offset + i * self._slab_size, i + 1 if i + 1 < self._slabs else _SHM_NONE)
+        _SHM_HEADER.pack_into(mm, 0, _SHM_MAGIC, self._slots, self._slabs, self._slab_size, 0, 0, 0)
+
+    def _locked(self, exclusive, fn, *args):
+        with self._lock:
+            if self._pid!=os.getpid():
+                # flock is shared with parent process after fork, so open again:
+                self._open()
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_EX if exclusive else self._fcntl.LOCK_SH)
+            try:
+                return fn(*args)
+            finally:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+
+    def _hash(self, key):
+        return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+    def _slot(self, i):
+        return _SHM_SLOT.unpack_from(self._mm, _SHM_HEADER_SIZE + _SHM_SLOT.size * i)
+
+    def _put_slot(self, i, state, slab, length, h, expires):
+        _SHM_SLOT.pack_into(self._mm, _SHM_HEADER_SIZE + _SHM_SLOT.size * i, state, slab, length, h, expires)
+
+    def _slab_key(self, slab):
+        offset = self._slab_offset + slab * self._slab_size
+        n = _SHM_KEY_LEN.unpack_from(self._mm, offset)[0]
+        return self._mm[offset + 2:offset + 2 + n]
+
+    def _slab_data(self, slab, length):
+        offset = self._slab_offset + slab * self._slab_size
+        n = _SHM_KEY_LEN.unpack_from(self._mm, offset)[0]
+        return self._mm[offset + 2 + n:offset + length]
+
+    def _find(self, key, h):
+        '''
+        Return (slot index, slot) of key, or (index of first free slot, None) if not found.
+        '''
+        free = None
+        i = h % self._slots
+        for n in xrange(self._slots):
+            slot = self._slot(i)
+            if slot[0]==_SLOT_EMPTY:
+                return (i if free is None else free), None
+            if slot[0]==_SLOT_DELETED:
+                if free is None:
+                    free = i
+            elif slot[3]==h and self._slab_key(slot[1])==key:
+                return i, slot
+            i = (i + 1) % self._slots
+        return free, None
+
+    def _alloc(self):
+        magic, slots, slabs, slab_size, free, clock, deleted = _SHM_HEADER.unpack_from(self._mm, 0)
+        while free==_SHM_NONE:
+            # evict by clock hand:
+            slot = self._slot(clock)
+            if slot[0]==_SLOT_USED:
+                self._put_slot(clock, _SLOT_DELETED, 0, 0, 0, 0)
+                deleted += 1
+                free = slot[1]
+                _SHM_NEXT.pack_into(self._mm, self._slab_offset + free * self._slab_size, _SHM_NONE)
+            clock = (clock + 1) % self._slots
+        nxt = _SHM_NEXT.unpack_from(self._mm, self._slab_offset + free * self._slab_size)[0]
+        _SHM_HEADER.pack_into(self._mm, 0, magic, slots, slabs, slab_size, nxt, clock, deleted)
+        if deleted >= self._max_deleted:
+            self._rehash()
+        return free
+
+    def _free(self, slab):
+        magic, slots, slabs, slab_size, free, clock, deleted = _SHM_HEADER.unpack_from(self._mm, 0)
+        _SHM_NEXT.pack_into(self._mm, self._slab_offset + slab * self._slab_size, free)
+        _SHM_HEADER.pack_into(self._mm, 0, magic, slots, slabs, slab_size, slab, clock, deleted)
+
+    def _add_deleted(self, n):
+        magic, slots, slabs, slab_size, free, clock, deleted = _SHM_HEADER.unpack_from(self._mm, 0)
+        _SHM_HEADER.pack_into(self._mm, 0, magic, slots, slabs, slab_size, free, clock, deleted + n)
+        return deleted + n
+
+    def _rehash(self):
+        '''
+        Insert used slots again into a cleared table to drop all deleted slots.
+        '''
+        used = [s for s in map(self._slot, xrange(self._slots)) if s[0]==_SLOT_USED]
+        self._mm[_SHM_HEADER_SIZE:self._slab_offset] = '\0' * (self._slab_offset - _SHM_HEADER_SIZE)
+        for s in used:
+            i = s[3] % self._slots
+            while self._slot(i)[0]!=_SLOT_EMPTY:
+                i = (i + 1) % self._slots
+            self._put_slot(i, *s)
+        magic, slots, slabs, slab_size, free, clock, deleted = _SHM_HEADER.unpack_from(self._mm, 0)
+        _SHM_HEADER.pack_into(self._mm, 0, magic, slots, slabs, slab_size, free, clock, 0)
+
+    def _delete(self, key):
+        i, slot = self._find(key, self._hash(key))
+        if slot:
+            self._put_slot(i, _SLOT_DELETED, 0, 0, 0, 0)
+            self._free(slot[1])
+            if self._add_deleted(1) >= self._max_deleted:
+                self._rehash()
+        return slot
+
+    def _put(self, key, data, expires, only_new=False):
+        h = self._hash(key)
+        i, slot = self._find(key, h)
+        if slot and only_new and not (slot[4] and slot[4] <= time.time()):
+            return False
+        length = 2 + len(key) + len(data)
+        if length > self._slab_size:
+            logging.debug('value too large for mmap cache: %s' % key)
+            if slot:
+                self._delete(key)
+            return False
+        if slot:
+            slab = slot[1]
+        else:
+            slab = self._alloc()
+            # eviction may free a slot before the one found, or rehash:
+            i, slot = self._find(key, h)
+            if self._slot(i)[0]==_SLOT_DELETED:
+                self._add_deleted(-1)
+        offset = self._slab_offset + slab * self._slab_size
+        _SHM_KEY_LEN.pack_into(self._mm, offset, len(key))
+        self._mm[offset + 2:offset + length] = '%s%s' % (key, data)
+        self._put_slot(i, _SLOT_USED, slab, length, h, time.time() + expires if expires else 0)
+        return True
+
+    def _get(self, key, now):
+        i, slot = self._find(key, self._hash(key))
+        if slot is None or (slot[4] and slot[4] <= now):
+            return None
+        return self._slab_data(slot[1], slot[2])
+
+    def _gets(self, keys):
+        now = time.time()
+        return [self._get(key, now) for key in keys]
+
+    def set(self, key, value, expires=0, tags=None):
+        if tags:
+            value = self._tag(value, self._tag_versions(tags))
+        self._locked(True, self._put, key, self._codec.dumps(value), expires)
+
+    setint = set
+
+    def sets(self, mapping, expires=0, tags=None):
+        if tags:
+            versions = self._tag_versions(tags)
+            mapping = dict([(k, self._tag(v, versions)) for k, v in mapping.iteritems()])
+        data = [(k, self._codec.dumps(v)) for k, v in mapping.iteritems()]
+        def _sets():
+            for k, d in data:
+                self._put(k, d, expires)
+        self._locked(True, _sets)
+
+    def add(self, key, value, expires=0):
+        return self._locked(True, self._put, key, self._codec.dumps(value), expires, True)
+
+    def _touch(self, key, expires):
+        now = time.time()
+        i, slot = self._find(key, self._hash(key))
+        if slot and now < slot[4] < now + expires:
+            self._put_slot(i, slot[0], slot[1], slot[2], slot[3], now + expires)
+
+    def touch(self, key, expires):
+        '''
+        Extend expires of key to expires seconds from now. Key that never expires 
+        or expires later is not changed.
+        '''
+        self._locked(True, self._touch, key, expires)
+
+    def get(self, key, default=None):
+        r = _safe_loads(self._codec, self._locked(False, self._gets, (key,))[0])
+        if _is_tagged(r):
+            r = self._untag([r])[0]
+        return default if r is None else r
+
+    def gets(self, *keys):
+        return self._untag(map(lambda r: _safe_loads(self._codec, r), self._locked(False, self._gets, keys)))
+
+    def getint(self, key, default=0):
+        return _safe_int(self.get(key), default)
+
+    def getints(self, *keys):
+        return map(_safe_int, self.gets(*keys))
+
+    def delete(self, key):
+        self._locked(True, self._delete, key)
+
+    def deletes(self, *keys):
+        def _deletes():
+            for key in keys:
+                self._delete(key)
+        self._locked(True, _deletes)
+
+    def _incrs(self, mapping):
+        now = time.time()
+        rs = dict()
+        for key, delta in mapping.iteritems():
+            h = self._hash(key)
+            i, slot = self._find(key, h)
+            expires = 0
+            r = delta
+            if slot and not (slot[4] and slot[4] <= now):
+                r = _safe_int(_safe_loads(self._codec, self._slab_data(slot[1], slot[2]))) + delta
+                expires = slot[4] - now if slot[4] else 0
+            self._put(key, self._codec.dumps(r), expires)
+            rs[key] = r
+        return rs
+
+    def incr(self, key, delta=1):
+        return self._locked(True, self._incrs, {key: delta})[key]
+
+    def incrs(self, *keys):
+        return [self.incr(key) for key in keys]
+
+    def incrs_by(self, mapping):
+        return self._locked(True, self._incrs, mapping)
+
+    def decr(self, key, delta=1):
+        return self.incr(key, -delta)
+
+class _SpaceSaving(object):
+    '''
+    Space-Saving sketch that tracks top-N heavy hitters in fixed space. Keys are 
+    grouped in buckets by count (stream-summary) so add() is O(1) when full.
+
+    >>> s = _SpaceSaving(3)
+    >>> for k in 'aaaaabbbbccd':
+    ...     s.add(k)
+    >>> s.top(2)
+    [('a', 5), ('b', 4)]
+    >>> s.top(3)
+    [('a', 5), ('b', 4), ('d', 3)]
+    >>> s = _SpaceSaving(100)
+    >>> for i in xrange(100000):
+    ...     s.add('hot' if i % 2 else 'k%d' % i)
+    >>> s.top(1), len(s.counts), sum(map(len, s.buckets.itervalues()))
+    ([('hot', 50000)], 100, 100)
+    '''
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = dict()
+        self.buckets = dict()
+        self.min = 0
+
+    def _move(self, key, n):
+        b = self.buckets.get(n)
+        if b is None:
+            b = self.buckets[n] = set()
+        b.add(key)
+        self.counts[key] = n
+
+    def add(self, key):
+        n = self.counts.get(key)
+        if n is None:
+            if len(self.counts) < self.capacity:
+                self._move(key, 1)
+                self.min = 1
+                return
+            # replace any key with the minimal count:
+            n = self.min
+            b = self.buckets[n]
+            del self.counts[b.pop()]
+        else:
+            b = self.buckets[n]
+            b.discard(key)
+        if not b:
+            del self.buckets[n]
+            if n == self.min:
+                self.min = n + 1
+        self._move(key, n + 1)
+
+    def top(self, n):
+        return sorted(self.counts.iteritems(), key=lambda x: (-x[1], x[0]))[:n]
+
+# upper bounds of latency (ms) and size (bytes) histogram buckets:
+_LATENCY_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+_SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+def _bucket(buckets, v):
+    return bisect.bisect_left(buckets, v)
+
+class InstrumentedClient(BaseClient):
+    '''
+    Cache client wrapper that counts hits, misses, sets and errors per key prefix 
+    (text before the first ':'), records latency histogram per operation and size 
+    histogram of set values, and tracks hot keys by Space-Saving sketch.
+
+    Sizes of str values are always recorded, but other values are pickled to 
+    measure their size only once every size_sample sets.
+
+    >>> c = InstrumentedClient(LocalClient())
+    >>> c.set('user:1', 'Bob')
+    >>> c.gets('user:1', 'user:2'), c.get('user:1'), c.get('article:1', 'N/A')
+    (['Bob', None], 'Bob', 'N/A')
+    >>> st = c.stats()
+    >>> sorted(st['prefixes']['user'].items())
+    [('errors', 0), ('hits', 2), ('misses', 1), ('sets', 1)]
+    >>> st['prefixes']['article']['misses']
+    1
+    >>> st['hot_keys'][0]
+    ('user:1', 2)
+    >>> print c.export().splitlines()[0]
+    prefix article hits=0 misses=1 sets=0 errors=0 hit_ratio=0.000
+    >>> c = InstrumentedClient(LocalClient(), size_sample=10)
+    >>> c.sets(dict([('user:%d' % i, dict(id=i)) for i in range(20)]))
+    >>> c.set('user:name', 'x' * 100)
+    >>> c.stats()['prefixes']['user']['sets'], sum(c.stats()['sizes'])
+    (21, 3)
+    '''
+    def __init__(self, client, hot_keys=100, size_sample=100):
+        '''
+        Init InstrumentedClient.
+
+        Args:
+            client: cache client to wrap.
+            hot_keys: capacity of hot keys sketch, default to 100.
+            size_sample: measure size of one in every size_sample non-str values, default to 100.
         '''
-        return self._client.decr(key)
+        self._client = client
+        self._hot_keys = hot_keys
+        self._size_sample = size_sample
+        self._lock = threading.Lock()
+        self._sketch_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._prefixes = dict()
+            self._latencies = dict()
+            self._sizes = [0] * (len(_SIZE_BUCKETS) + 1)
+            self._unsized = 0
+        with self._sketch_lock:
+            self._sketch = _SpaceSaving(self._hot_keys)
+
+    def _prefix(self, key):
+        name = key.split(':', 1)[0]
+        p = self._prefixes.get(name)
+        if p is None:
+            p = self._prefixes[name] = dict(hits=0, misses=0, sets=0, errors=0)
+        return p
+
+    def _call(self, op, keys, fn, *args):
+        start = time.time()
+        try:
+            r = fn(*args)
+        except Exception:
+            with self._lock:
+                for key in keys:
+                    self._prefix(key)['errors'] += 1
+            raise
+        t = (time.time() - start) * 1000
+        with self._lock:
+            L = self._latencies.get(op)
+            if L is None:
+                L = self._latencies[op] = [0] * (len(_LATENCY_BUCKETS) + 1)
+            L[_bucket(_LATENCY_BUCKETS, t)] += 1
+        return r
+
+    def _reads(self, keys, values):
+        with self._lock:
+            for key, v in zip(keys, values):
+                self._prefix(key)['misses' if v is None else 'hits'] += 1
+        with self._sketch_lock:
+            for key in keys:
+                self._sketch.add(key)
+
+    def _writes(self, mapping):
+        sampled = []
+        with self._lock:
+            for key, v in mapping.iteritems():
+                self._prefix(key)['sets'] += 1
+                if isinstance(v, str):
+                    self._sizes[_bucket(_SIZE_BUCKETS, len(v))] += 1
+                    continue
+                self._unsized += 1
+                if self._unsized >= self._size_sample:
+                    self._unsized = 0
+                    sampled.append(v)
+        if sampled:
+            sizes = [len(pickle.dumps(v, pickle.HIGHEST_PROTOCOL)) for v in sampled]
+            with self._lock:
+                for size in sizes:
+                    self._sizes[_bucket(_SIZE_BUCKETS, size)] += 1
+
+    def set(self, key, value, expires=0, tags=None):
+        self._call('set', (key,), self._client.set, key, value, expires, tags)
+        self._writes({key: value})
+
+    def sets(self, mapping, expires=0, tags=None):
+        self._call('sets', mapping.keys(), self._client.sets, mapping, expires, tags)
+        self._writes(mapping)
+
+    def add(self, key, value, expires=0):
+        r = self._call('add', (key,), self._client.add, key, value, expires)
+        if r:
+            self._writes({key: value})
+        return r
+
+    def setint(self, key, value, expires=0):
+        return self._call('setint', (key,), self._client.setint, key, value, expires)
+
+    def touch(self, key, expires):
+        return self._call('touch', (key,), self._client.touch, key, expires)
+
+    def get(self, key, default=None):
+        r = self._call('get', (key,), self._client.get, key)
+        self._reads((key,), (r,))
+        return default if r is None else r
+
+    def gets(self, *keys):
+        L = self._call('gets', keys, self._client.gets, *keys)
+        self._reads(keys, L)
+        return L
+
+    def getint(self, key, default=0):
+        return self._call('getint', (key,), self._client.getint, key, default)
+
+    def getints(self, *keys):
+        return self._call('getints', keys, self._client.getints, *keys)
+
+    def delete(self, key):
+        return self._call('delete', (key,), self._client.delete, key)
+
+    def deletes(self, *keys):
+        return self._call('deletes', keys, self._client.deletes, *keys)
+
+    def incr(self, key, delta=1):
+        return self._call('incr', (key,), self._client.incr, key, delta)
+
+    def incrs(self, *keys):
+        return self._call('incrs', keys, self._client.incrs, *keys)
+
+    def incrs_by(self, mapping):
+        return self._call('incrs_by', mapping.keys(), self._client.incrs_by, mapping)
+
+    def decr(self, key, delta=1):
+        return self._call('decr', (key,), self._client.decr, key, delta)
+
+    def stats(self, top=10):
+        '''
+        Return snapshot of statistics as dict.
+        '''
+        with self._sketch_lock:
+            hot_keys = self._sketch.top(top)
+        with self._lock:
+            return dict( \
+                prefixes=dict([(k, dict(v)) for k, v in self._prefixes.iteritems()]), \
+                latencies=dict([(k, list(v)) for k, v in self._latencies.iteritems()]), \
+                sizes=list(self._sizes), \
+                hot_keys=hot_keys)
+
+    def export(self, top=10):
+        '''
+        Return snapshot of statistics as text.
+        '''
+        st = self.stats(top)
+        L = []
+        for k, v in sorted(st['prefixes'].iteritems()):
+            reads = v['hits'] + v['misses']
+            L.append('prefix %s hits=%d misses=%d sets=%d errors=%d hit_ratio=%.3f' % \
+                (k, v['hits'], v['misses'], v['sets'], v['errors'], float(v['hits']) / reads if reads else 0.0))
+        for op, v in sorted(st['latencies'].iteritems()):
+            L.append('latency %s %s' % (op, _format_histogram(_LATENCY_BUCKETS, v, 'ms')))
+        L.append('size %s' % _format_histogram(_SIZE_BUCKETS, st['sizes'], 'B'))
+        for k, n in st['hot_keys']:
+            L.append('hot %s %d' % (k, n))
+        return '\n'.join(L)
+
+def _format_histogram(buckets, counts, unit):
+    L = ['<=%s%s:%d' % (b, unit, n) for b, n in zip(buckets, counts)]
+    L.append('>%s%s:%d' % (buckets[-1], unit, counts[-1]))
+    return ' '.join(L)
+
+class BreakerClient(BaseClient):
+    '''
+    Cache client wrapper with circuit breaker. After failures consecutive errors 
+    the circuit opens and all calls fail fast as DummyClient (cache miss) without 
+    touching the cache. After reset seconds it is half-open: one call is tried, and 
+    the circuit closes if it succeeds, or opens again if it fails.
+
+    >>> class BrokenClient(LocalClient):
+    ...     def get(self, key, default=None):
+    ...         raise IOError('timed out')
+    >>> c = BreakerClient(BrokenClient(), failures=2, reset=0.5)
+    >>> c.state, c.get('key', 'N/A'), c.state, c.get('key'), c.state
+    ('closed', 'N/A', 'closed', None, 'open')
+    >>> c.set('key', 'Value')
+    >>> c.gets('key')
+    [None]
+    >>> time.sleep(0.6)
+    >>> c.state
+    'half-open'
+    >>> c.gets('key'), c.state
+    ([None], 'closed')
+    '''
+    def __init__(self, client, failures=5, reset=30):
+        '''
+        Init BreakerClient.
+
+        Args:
+            client: cache client to wrap.
+            failures: consecutive errors to open the circuit, default to 5.
+            reset: seconds before half-open, default to 30.
+        '''
+        self._client = client
+        self._dummy = DummyClient()
+        self._failures = failures
+        self._reset = reset
+        self._lock = threading.Lock()
+        self._errors = 0
+        self._opened = 0
+        self._trial = False
+
+    @property
+    def state(self):
+        if not self._opened:
+            return 'closed'
+        if self._trial or time.time() < self._opened + self._reset:
+            return 'open'
+        return 'half-open'
+
+    def _allow(self):
+        if not self._opened:
+            return True
+        with self._lock:
+            if self._trial or time.time() < self._opened + self._reset:
+                return False
+            self._trial = True
+            return True
+
+    def _call(self, fallback, fn, *args):
+        if not self._allow():
+            return fallback(*args)
+        try:
+            r = fn(*args)
+        except Exception, e:
+            with self._lock:
+                self._errors = self._errors + 1
+                if self._trial or self._errors >= self._failures:
+                    if not self._opened:
+                        logging.warning('circuit opened after %d errors: %s' % (self._errors, e))
+                    self._opened = time.time()
+                self._trial = False
+            return fallback(*args)
+        if self._errors or self._opened:
+            with self._lock:
+                self._errors = 0
+                self._opened = 0
+                self._trial = False
+        return r
+
+    def set(self, key, value, expires=0, tags=None):
+        self._call(self._dummy.set, self._client.set, key, value, expires, tags)
+
+    def sets(self, mapping, expires=0, tags=None):
+        self._call(self._dummy.sets, self._client.sets, mapping, expires, tags)
+
+    def add(self, key, value, expires=0):
+        return self._call(self._dummy.add, self._client.add, key, value, expires)
+
+    def setint(self, key, value, expires=0):
+        return self._call(self._dummy.setint, self._client.setint, key, value, expires)
+
+    def touch(self, key, expires):
+        return self._call(self._dummy.touch, self._client.touch, key, expires)
+
+    def get(self, key, default=None):
+        return self._call(self._dummy.get, self._client.get, key, default)
+
+    def gets(self, *keys):
+        return self._call(self._dummy.gets, self._client.gets, *keys)
+
+    def getint(self, key, default=0):
+        return self._call(self._dummy.getint, self._client.getint, key, default)
+
+    def getints(self, *keys):
+        return self._call(self._dummy.getints, self._client.getints, *keys)
+
+    def delete(self, key):
+        return self._call(self._dummy.delete, self._client.delete, key)
+
+    def deletes(self, *keys):
+        return self._call(self._dummy.deletes, self._client.deletes, *keys)
+
+    def incr(self, key, delta=1):
+        return self._call(self._dummy.incr, self._client.incr, key, delta)
+
+    def incrs(self, *keys):
+        return self._call(self._dummy.incrs, self._client.incrs, *keys)
+
+    def incrs_by(self, mapping):
+        return self._call(self._dummy.incrs_by, self._client.incrs_by, mapping)
+
+    def decr(self, key, delta=1):
+        return self._call(self._dummy.decr, self._client.decr, key, delta)
+
+    def publish(self, channel, message):
+        return self._call(lambda *args: None, self._client.publish, channel, message)
+
+    def subscribe(self, channel, callback):
+        return self._client.subscribe(channel, callback)
+
+class ExpirationClient(BaseClient):
+    '''
+    Cache client wrapper with expiration policy:
+
+    jitter: expires of each set is randomized in [1 - jitter, 1 + jitter] times, so 
+    keys set together do not expire together. Keys of one sets() are split into 
+    groups of different expires.
+
+    sliding: a key that is read at least sliding_hits times is written back with 
+    expires of sliding seconds, at most once per sliding / 2 seconds, so hot keys 
+    do not expire. The expire time is extended in place by touch() and never 
+    shortened, so keys that never expire keep so and tags of the value still work.
+
+    adaptive: expires of get_or_compute() is scaled by hit ratio * compute time / 
+    adaptive of the key prefix (text before the first ':'), in range of 0.5 to 4 
+    times, so keys that are expensive and often hit are cached longer.
+
+    >>> calls = []
+    >>> class RecordClient(LocalClient):
+    ...     def set(self, key, value, expires=0, tags=None):
+    ...         calls.append((key, expires))
+    ...         LocalClient.set(self, key, value, expires, tags)
+    ...     def touch(self, key, expires):
+    ...         calls.append((key, expires))
+    ...         LocalClient.touch(self, key, expires)
+    >>> c = ExpirationClient(RecordClient(), jitter=0.2)
+    >>> for i in range(100):
+    ...     c.set('key', 'Value', 100)
+    >>> all([80 <= t <= 120 for k, t in calls]), len(set([t for k, t in calls])) > 1
+    (True, True)
+    >>> c.set('forever', 'Value')
+    >>> calls[-1]
+    ('forever', 0)
+    >>> calls = []
+    >>> c = ExpirationClient(RecordClient(), jitter=0, sliding=1, sliding_hits=2)
+    >>> c.set('hot', 'Value', 1)
+    >>> for i in range(6):
+    ...     time.sleep(0.3)
+    ...     r = c.get('hot')
+    >>> r, calls
+    ('Value', [('hot', 1), ('hot', 1), ('hot', 1)])
+    >>> c.set('tagged', 'Value', 1, tags=['user'])
+    >>> for i in range(6):
+    ...     time.sleep(0.3)
+    ...     r = c.get('tagged')
+    >>> r, len(calls)
+    ('Value', 6)
+    >>> c.invalidate_tag('user')
+    >>> c.get('tagged')
+    >>> c.set('forever', 'Value')
+    >>> for i in range(6):
+    ...     time.sleep(0.3)
+    ...     r = c.get('forever')
+    >>> time.sleep(1.1)
+    >>> c.get('forever')
+    'Value'
+    >>> calls = []
+    >>> c = ExpirationClient(RecordClient(), jitter=0, adaptive=0.005)
+    >>> def slow():
+    ...     time.sleep(0.05)
+    ...     return 'Report'
+    >>> for i in range(9):
+    ...     r = c.get_or_compute('report:1', slow, 60)
+    >>> r = c.get_or_compute('report:2', slow, 60)
+    >>> r = c.get_or_compute('config:1', lambda: 'Config', 60)
+    >>> r = c.get_or_compute('config:2', lambda: 'Config', 60)
+    >>> calls
+    [('report:1', 60), ('report:2', 240), ('config:1', 60), ('config:2', 30)]
+    '''
+    def __init__(self, client, jitter=0.1, sliding=0, sliding_hits=3, adaptive=0, max_keys=10000):
+        '''
+        Init ExpirationClient.
+
+        Args:
+            client: cache client to wrap.
+            jitter: ratio of random expires, default to 0.1.
+            sliding: expires of renewed hot keys, default to 0 (no sliding).
+            sliding_hits: reads to renew a key, default to 3.
+            adaptive: compute time in seconds that keeps expires unchanged for hit ratio 
+                      1.0, default to 0 (not adaptive).
+            max_keys: max keys tracked for sliding, default to 10000.
+        '''
+        self._client = client
+        self._jitter = jitter
+        self._sliding = sliding
+        self._sliding_hits = sliding_hits
+        self._adaptive = adaptive
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        self._slides = collections.OrderedDict()
+        self._prefixes = dict()
+
+    def _expires(self, expires):
+        if not expires or not self._jitter:
+            return expires
+        return max(1, int(round(expires * random.uniform(1.0 - self._jitter, 1.0 + self._jitter))))
+
+    def _prefix(self, key):
+        '''
+        Return stats of key prefix as [hits, misses, compute time]. Must hold lock.
+        '''
+        name = key.split(':', 1)[0]
+        p = self._prefixes.get(name)
+        if p is None:
+            p = self._prefixes[name] = [0, 0, None]
+        return p
+
+    def _reads(self, keys, values):
+        now = time.time()
+        renews = []
+        with self._lock:
+            for key, value in zip(keys, values):
+                if self._adaptive:
+                    self._prefix(key)[0 if value is not None else 1] += 1
+                if not self._sliding or value is None:
+                    continue
+                s = self._slides.pop(key, None) or [0, now]
+                s[0] = s[0] + 1
+                if s[0] >= self._sliding_hits and now - s[1] >= self._sliding / 2.0:
+                    s[0], s[1] = 0, now
+                    renews.append(key)
+                self._slides[key] = s
+            while len(self._slides) > self._max_keys:
+                self._slides.popitem(last=False)
+        for key in renews:
+            self._client.touch(key, self._expires(self._sliding))
+
+    def _forget(self, keys):
+        if self._sliding:
+            with self._lock:
+                for key in keys:
+                    self._slides.pop(key, None)
+
+    def get_or_compute(self, key, fn, expires=0, *args, **kw):
+        if not self._adaptive or not expires:
+            return BaseClient.get_or_compute(self, key, fn, expires, *args, **kw)
+        with self._lock:
+            p = self._prefix(key)
+            if p[2] is not None:
+                ratio = float(p[0]) / (p[0] + p[1]) if p[0] + p[1] else 1.0
+                expires = int(expires * min(max(ratio * p[2] / self._adaptive, 0.5), 4.0))
+        def _fn():
+            start = time.time()
+            try:
+                return fn()
+            finally:
+                t = time.time() - start
+                with self._lock:
+                    p[2] = t if p[2] is None else p[2] * 0.8 + t * 0.2
+        return BaseClient.get_or_compute(self, key, _fn, expires, *args, **kw)
+
+    def set(self, key, value, expires=0, tags=None):
+        self._forget((key,))
+        self._client.set(key, value, self._expires(expires), tags)
+
+    def sets(self, mapping, expires=0, tags=None):
+        self._forget(mapping)
+        if not expires or not self._jitter or len(mapping) < 2:
+            return self._client.sets(mapping, self._expires(expires), tags)
+        groups = dict()
+        for key, value in mapping.iteritems():
+            groups.setdefault(hash(key) % 4, dict())[key] = value
+        for group in groups.itervalues():
+            self._client.sets(group, self._expires(expires), tags)
+
+    def add(self, key, value, expires=0):
+        return self._client.add(key, value, self._expires(expires))
+
+    def setint(self, key, value, expires=0):
+        return self._client.setint(key, value, self._expires(expires))
+
+    def touch(self, key, expires):
+        return self._client.touch(key, self._expires(expires))
+
+    def get(self, key, default=None):
+        r = self._client.get(key)
+        self._reads((key,), (r,))
+        return default if r is None else r
+
+    def gets(self, *keys):
+        L = self._client.gets(*keys)
+        self._reads(keys, L)
+        return L
+
+    def getint(self, key, default=0):
+        return self._client.getint(key, default)
+
+    def getints(self, *keys):
+        return self._client.getints(*keys)
+
+    def delete(self, key):
+        self._forget((key,))
+        return self._client.delete(key)
+
+    def deletes(self, *keys):
+        self._forget(keys)
+        return self._client.deletes(*keys)
+
+    def incr(self, key, delta=1):
+        return self._client.incr(key, delta)
+
+    def incrs(self, *keys):
+        return self._client.incrs(*keys)
+
+    def incrs_by(self, mapping):
+        return self._client.incrs_by(mapping)
+
+    def decr(self, key, delta=1):
+        return self._client.decr(key, delta)
+
+# counter buffers to flush at exit:
+_counter_buffers = weakref.WeakSet()
+
+def _close_counter_buffers():
+    for b in list(_counter_buffers):
+        try:
+            b.close()
+        except Exception:
+            logging.exception('close counter buffer failed.')
+
+atexit.register(_close_counter_buffers)
+
+class CounterBuffer(object):
+    '''
+    Buffer that aggregates counter increments in process and flushes them to cache 
+    client by incrs_by() every interval seconds and at exit.
+
+    The flush thread is started by the first incr() of each process, so a buffer 
+    created before fork also flushes in child processes. Deltas inherited from 
+    parent process are dropped in child process since parent flushes them.
+
+    >>> c = LocalClient()
+    >>> b = CounterBuffer(c, interval=0)
+    >>> for i in range(100):
+    ...     b.incr('hits')
+    >>> b.decr('stock', 3)
+    >>> c.getint('hits')
+    0
+    >>> b.flush()
+    >>> c.getints('hits', 'stock')
+    [100, -3]
+    >>> b.incr('hits')
+    >>> b.close()
+    >>> c.getint('hits')
+    101
+    >>> c = RedisClient('localhost:6379')
+    >>> key = uuid.uuid4().hex
+    >>> b = CounterBuffer(c, interval=0.05)
+    >>> b.incr(key)
+    >>> pid = os.fork()
+    >>> if pid==0:
+    ...     signal.alarm(5)
+    ...     b.incr(key, 10)
+    ...     time.sleep(0.5)
+    ...     os._exit(0)
+    >>> os.waitpid(pid, 0)[1]
+    0
+    >>> c.getint(key)
+    11
+    >>> b.close()
+    >>> c.getint(key)
+    11
+    >>> b = CounterBuffer(c, interval=0)
+    >>> for i in range(5):
+    ...     b.incr(key)
+    >>> pid = os.fork()
+    >>> if pid==0:
+    ...     _close_counter_buffers()
+    ...     os._exit(0)
+    >>> os.waitpid(pid, 0)[1]
+    0
+    >>> b.close()
+    >>> c.getint(key)
+    16
+    '''
+    def __init__(self, client=None, interval=1.0):
+        '''
+        Init CounterBuffer.
+
+        Args:
+            client: cache client, default to None (using cache.client).
+            interval: seconds between flushes, default to 1.0. 0 means only flush manually.
+        '''
+        self._client = client
+        self._interval = interval
+        self._counts = dict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+        _counter_buffers.add(self)
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('flush counters failed.')
+
+    def _check_pid(self):
+        '''
+        Drop deltas and flush thread inherited from parent process. Must be called 
+        with lock held.
+        '''
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._counts = dict()
+            self._thread = None
+
+    def _start(self):
+        '''
+        Start flush thread of this process. Must be called with lock held.
+        '''
+        self._check_pid()
+        if self._interval and self._thread is None and not self._stop.is_set():
+            self._thread = threading.Thread(target=self._run, args=(self._interval,), name='counter-buffer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._start()
+            self._counts[key] = self._counts.get(key, 0) + delta
+
+    def decr(self, key, delta=1):
+        self.incr(key, -delta)
+
+    def flush(self):
+        '''
+        Send buffered deltas to cache. Deltas are kept in buffer if failed.
+        '''
+        with self._lock:
+            self._check_pid()
+            counts, self._counts = self._counts, dict()
+        counts = dict([(k, d) for k, d in counts.iteritems() if d])
+        if not counts:
+            return
+        try:
+            (self._client or client).incrs_by(counts)
+        except Exception:
+            with self._lock:
+                for k, d in counts.iteritems():
+                    self._counts[k] = self._counts.get(k, 0) + d
+            raise
+
+    def close(self):
+        '''
+        Stop flush thread and flush buffered deltas.
+        '''
+        self._stop.set()
+        with self._lock:
+            self._check_pid()
+            t = self._thread
+        if t and t is not threading.current_thread():
+            t.join()
+        self.flush()
 
 client = DummyClient()
 
+def _namespace_key(namespace):
+    return '__ns__:%s' % namespace
+
+def _namespace_version(c, namespace):
+    key = _namespace_key(namespace)
+    v = c.getint(key)
+    if not v:
+        # init version by time in microseconds so an evicted namespace key 
+        # never matches old objects:
+        v = int(time.time() * 1000000)
+        c.setint(key, v)
+    return v
+
+def invalidate_namespace(namespace, c=None):
+    '''
+    Invalidate all keys cached by @cached(namespace=namespace) by increasing version 
+    of namespace.
+    '''
+    c = c or client
+    key = _namespace_key(namespace)
+    if c.getint(key):
+        c.incr(key)
+    else:
+        c.setint(key, int(time.time() * 1000000))
+
+# default repr of object contains memory address that differs by process:
+_re_address = re.compile(r' at 0x[0-9a-fA-F]+>')
+
+def cached(expires=0, key=None, namespace=None, client=None, missing_expires=0, bloom=None, bloom_key=None):
+    '''
+    A decorator that caches result of function by cache client.
+
+    Cache key is made of module and name of function and md5 of repr of args 
+    bound to argument names, so f(1) and f(id=1) make the same key, or by 
+    key(*args, **kw) if key function is given. Keys with namespace contain 
+    version of namespace so invalidate_namespace() drops all of them at once.
+
+    Args with default repr (e.g. self of method) contain memory address that never 
+    matches in other processes, so ValueError is raised for them and key function 
+    is required.
+
+    The decorated function has invalidate(*args, **kw) to delete the cached result. 
+    It can decorate a @view handler so the handler is skipped when cached, but the 
+    cached Template is still rendered for each request.
+
+    Args:
+        expires: cache time, default to 0 (using default expires time).
+        key: function that returns key by args, default to None.
+        namespace: namespace of keys, default to None.
+        client: cache client, default to None (using cache.client).
+        missing_expires: cache time of None result, default to 0 (using expires).
+        bloom: BloomFilter of all existing keys, default to None. None is returned 
+               without reading cache if bloom_key(*args, **kw) is not in bloom.
+        bloom_key: function that returns key checked in bloom, default to None (using 
+                   key function). Either of key and bloom_key is required by bloom.
+
+    >>> c = LocalClient()
+    >>> calls = []
+    >>> @cached(60, namespace='user', client=c)
+    ... def get_user(id, detail=False):
+    ...     calls.append(id)
+    ...     return dict(id=id, detail=detail)
+    >>> get_user(1)
+    {'detail': False, 'id': 1}
+    >>> get_user(1), get_user(1, detail=True), len(calls)
+    ({'detail': False, 'id': 1}, {'detail': True, 'id': 1}, 2)
+    >>> get_user(id=1), get_user(1, False), len(calls)
+    ({'detail': False, 'id': 1}, {'detail': False, 'id': 1}, 2)
+    >>> get_user.invalidate(id=1)
+    >>> r = get_user(1)
+    >>> len(calls)
+    3
+    >>> invalidate_namespace('user', c)
+    >>> r = get_user(1), get_user(1, detail=True)
+    >>> len(calls)
+    5
+    >>> c.delete('__ns__:user')
+    >>> r = get_user(1)
+    >>> len(calls)
+    6
+    >>> class UserService(object):
+    ...     @cached(60, client=c)
+    ...     def get(self, id):
+    ...         return id
+    >>> UserService().get(1)
+    Traceback (most recent call last):
+      ...
+    ValueError: cannot make cache key of get() by args with default repr, use key function.
+    >>> import web
+    >>> @cached(60, key=lambda id: 'page:user:%d' % id, client=c)
+    ... @web.view('user.html')
+    ... def user_page(id):
+    ...     calls.append(id)
+    ...     return dict(user_id=id)
+    >>> n = len(calls)
+    >>> t1, t2 = user_page(7), user_page(7)
+    >>> isinstance(t2, web.Template), t2.template_name, t2.model['user_id'], len(calls) - n
+    (True, 'user.html', 7, 1)
+    >>> b = BloomFilter(100)
+    >>> b.add('user:1')
+    >>> @cached(60, key=lambda id: 'user:%d' % id, namespace='u', client=c, bloom=b)
+    ... def get_user(id):
+    ...     calls.append(id)
+    ...     return 'User %d' % id
+    >>> get_user(1), get_user(2), calls[-1]
+    ('User 1', None, 1)
+    >>> invalidate_namespace('u', c)
+    >>> get_user(1), calls[-1]
+    ('User 1', 1)
+    >>> @cached(60, namespace='u', client=c, bloom=b, bloom_key=lambda id: 'user:%d' % id)
+    ... def get_profile(id):
+    ...     return 'Profile %d' % id
+    >>> get_profile(1), get_profile(2)
+    ('Profile 1', None)
+    '''
+    if bloom is not None and key is None and bloom_key is None:
+        raise ValueError('bloom requires key or bloom_key function.')
+    def _decorator(func):
+        prefix = '%s.%s' % (func.__module__, func.__name__)
+        def _client():
+            return client or globals()['client']
+        def _key(args, kw):
+            if key:
+                k = key(*args, **kw)
+            else:
+                try:
+                    r = repr(sorted(inspect.getcallargs(func, *args, **kw).iteritems()))
+                except TypeError:
+                    r = repr((args, sorted(kw.iteritems())))
+                if _re_address.search(r):
+                    raise ValueError('cannot make cache key of %s() by args with default repr, use key function.' % func.__name__)
+                k = '%s:%s' % (prefix, hashlib.md5(r).hexdigest())
+            if namespace:
+                k = '%s:%s:%s' % (namespace, _namespace_version(_client(), namespace), k)
+            return k
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            if bloom is not None and not (bloom_key or key)(*args, **kw) in bloom:
+                return None
+            return _client().get_or_compute(_key(args, kw), lambda: func(*args, **kw), expires, \
+                missing_expires=missing_expires)
+        def _invalidate(*args, **kw):
+            _client().delete(_key(args, kw))
+        _wrapper.invalidate = _invalidate
+        return _wrapper
+    return _decorator
+
+# registered warmers as list of (namespace, func, expires):
+_warmers = []
+
+def warmer(namespace, expires=0):
+    '''
+    A decorator that registers func() as warmer of namespace for warm_up(). The func 
+    returns dict or iterable of (key, value) to preload, or None if it fills cache 
+    by itself (e.g. calls @cached functions).
+
+    Args:
+        namespace: name of warmer used to select warmers to run.
+        expires: cache time of preloaded keys, default to 0 (using default expires time).
+    '''
+    def _decorator(func):
+        _warmers.append((namespace, func, expires))
+        return func
+    return _decorator
+
+class _RateLimiter(object):
+    '''
+    Token bucket that allows rate tokens per second, shared by threads.
+    '''
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def acquire(self, n=1):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + n / self._rate
+        if start > now:
+            time.sleep(start - now)
+
+# rate limiter of warm_up() running in current thread:
+_warm_up_ctx = threading.local()
+
+def pace(n=1):
+    '''
+    Wait until n keys are allowed by rate of the warm_up() that runs the calling 
+    warmer, or return immediately if not called by a warmer or rate is not set. 
+    Warmers that return dict or None should call it before each db query.
+    '''
+    limiter = getattr(_warm_up_ctx, 'limiter', None)
+    if limiter:
+        limiter.acquire(n)
+
+def warm_up(namespaces=None, c=None, workers=4, rate=0, batch=100, lock_expires=0):
+    '''
+    Run registered warmers concurrently and write their keys by sets() in batches. 
+    Each warmer runs in a db.connection() so its queries share one connection.
+
+    Rate limits db queries of warmers that return iterable (e.g. generator), since 
+    each batch of keys is pulled from it after the previous batch is paced. Warmers 
+    that return dict or None have done all queries before returning, so they must 
+    call pace() before each query to be rate limited.
+
+    Args:
+        namespaces: list of namespaces to warm up, default to None (all warmers).
+        c: cache client, default to None (using cache.client).
+        workers: number of warmers running at the same time, default to 4.
+        rate: max keys loaded per second, default to 0 (no limit).
+        batch: max keys of one sets(), default to 100.
+        lock_expires: seconds of lock added to cache so other processes sharing the 
+                      cache skip warm up, default to 0 (no lock).
+
+    Returns:
+        dict of namespace -> number of preloaded keys, or None if warmer failed, or 
+        None if skipped by lock.
+
+    >>> c = LocalClient()
+    >>> @warmer('test:article', expires=60)
+    ... def top_articles():
+    ...     return dict([('article:%d' % i, 'Article %d' % i) for i in range(250)])
+    >>> @warmer('test:config')
+    ... def config():
+    ...     yield 'config:site', 'transwarp'
+    >>> @warmer('test:broken')
+    ... def broken():
+    ...     raise IOError('db is down')
+    >>> sorted(warm_up(['test:article', 'test:config', 'test:broken'], c, rate=1000).items())
+    [('test:article', 250), ('test:broken', None), ('test:config', 1)]
+    >>> c.gets('article:249', 'config:site')
+    ['Article 249', 'transwarp']
+    >>> @warmer('test:paced')
+    ... def paced():
+    ...     d = dict()
+    ...     for page in range(3):
+    ...         pace(100)
+    ...         d.update([('paced:%d' % i, i) for i in range(page * 100, page * 100 + 100)])
+    ...     return d
+    >>> t = time.time()
+    >>> warm_up(['test:paced'], c, rate=1000)
+    {'test:paced': 300}
+    >>> time.time() - t >= 0.2
+    True
+    >>> warm_up(['test:config'], c, lock_expires=60), warm_up(['test:config'], c, lock_expires=60)
+    ({'test:config': 1}, None)
+    '''
+    import db
+    from multiprocessing.pool import ThreadPool
+    L = [w for w in _warmers if namespaces is None or w[0] in namespaces]
+    if lock_expires and not (c or client).add('__warm_up__:lock', 1, lock_expires):
+        logging.info('skip warm up that is running by other process.')
+        return None
+    limiter = _RateLimiter(rate) if rate else None
+    def _run(w):
+        namespace, func, expires = w
+        start = time.time()
+        n = 0
+        _warm_up_ctx.limiter = limiter
+        try:
+            with db.connection():
+                r = func()
+                if r is None:
+                    return namespace, 0
+                items = r.iteritems() if isinstance(r, dict) else iter(r)
+                while True:
+                    mapping = dict(itertools.islice(items, batch))
+                    if not mapping:
+                        break
+                    if limiter:
+                        limiter.acquire(len(mapping))
+                    (c or client).sets(mapping, expires)
+                    n = n + len(mapping)
+        except Exception:
+            logging.exception('warm up %s failed after %d keys.' % (namespace, n))
+            return namespace, None
+        finally:
+            _warm_up_ctx.limiter = None
+        logging.info('warm up %s: %d keys in %.3f sec.' % (namespace, n, time.time() - start))
+        return namespace, n
+    if not L:
+        return dict()
+    pool = ThreadPool(min(workers, len(L)))
+    try:
+        return dict(pool.map(_run, L))
+    finally:
+        pool.close()
+
+def _main(argv):
+    '''
+    Command line entry point:
+
+    python -m transwarp.cache warmup [-n namespace] [-w workers] [-r rate] module ...
+
+    Modules are imported to init db and cache.client and register warmers.
+    '''
+    import sys, argparse
+    from utils import load_module
+    parser = argparse.ArgumentParser(prog='python -m transwarp.cache', description='Warm up cache by registered warmers.')
+    parser.add_argument('command', choices=['warmup'])
+    parser.add_argument('modules', nargs='+', help='modules that init db, cache.client and warmers')
+    parser.add_argument('-n', '--namespace', action='append', help='namespace to warm up, default to all')
+    parser.add_argument('-w', '--workers', type=int, default=4, help='warmers running at the same time')
+    parser.add_argument('-r', '--rate', type=int, default=0, help='max keys written per second')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    for name in args.modules:
+        load_module(name)
+    # warmers and client are registered to transwarp.cache, not to __main__:
+    mod = sys.modules.get('transwarp.cache', sys.modules[__name__])
+    results = mod.warm_up(args.namespace, workers=args.workers, rate=args.rate)
+    for namespace, n in sorted(results.iteritems()):
+        print '%-20s %s' % (namespace, 'FAILED' if n is None else '%d keys' % n)
+    return 0 if None not in results.values() else 1
+
+class _Deferred(object):
+    '''
+    Value of key that is loaded by Loader at the first access.
+    '''
+    def __init__(self, loader, key):
+        self._loader = loader
+        self.key = key
+
+    def get(self, default=None):
+        r = self._loader.get(self.key)
+        return default if r is None else r
+
+class Loader(object):
+    '''
+    Loader that batches gets: keys of load() are collected until any value is 
+    accessed, then all pending keys are read by one gets(). Values (including 
+    misses) are memoized, so get a key again costs nothing.
+
+    >>> c = InstrumentedClient(LocalClient())
+    >>> c.sets({'user:1': 'Bob', 'user:2': 'Alice'})
+    >>> l = Loader(c)
+    >>> u1, u2, u3 = l.load('user:1'), l.load('user:2'), l.load('user:3')
+    >>> u1.get(), u2.get(), u3.get('N/A'), l.get('user:1'), l.gets('user:2', 'user:4')
+    ('Bob', 'Alice', 'N/A', 'Bob', ['Alice', None])
+    >>> sorted(c.stats()['latencies'].keys()), sum(c.stats()['latencies']['gets'])
+    (['gets', 'sets'], 2)
+    '''
+    def __init__(self, client=None):
+        '''
+        Init Loader.
+
+        Args:
+            client: cache client, default to None (using cache.client).
+        '''
+        self._client = client
+        self._values = dict()
+        self._pending = []
+
+    def load(self, key):
+        '''
+        Return deferred value of key which has get(default=None).
+        '''
+        if not key in self._values:
+            self._pending.append(key)
+        return _Deferred(self, key)
+
+    def _flush(self):
+        keys = [k for k in self._pending if not k in self._values]
+        self._pending = []
+        if keys:
+            keys = list(collections.OrderedDict.fromkeys(keys))
+            self._values.update(zip(keys, (self._client or client).gets(*keys)))
+
+    def get(self, key, default=None):
+        if not key in self._values:
+            self._pending.append(key)
+            self._flush()
+        r = self._values[key]
+        return default if r is None else r
+
+    def gets(self, *keys):
+        self._pending.extend(keys)
+        self._flush()
+        return [self._values[k] for k in keys]
+
+def loader():
+    '''
+    Return Loader of current request that reads from cache.client, or a new Loader 
+    if not in a request of web.WSGIApplication.
+    '''
+    import web
+    request = getattr(web.ctx, 'request', None)
+    if request is None:
+        return Loader()
+    l = getattr(request, '_cache_loader', None)
+    if l is None:
+        l = request._cache_loader = Loader()
+    return l
+
 if __name__=='__main__':
-    import uuid, doctest
+    import sys
+    if len(sys.argv) > 1:
+        sys.exit(_main(sys.argv[1:]))
+    import uuid, signal, doctest, cacheserver
+    # use stand-in servers if no memcache or redis is running on localhost:
+    cacheserver.serve_defaults()
     doctest.testmod()
@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Michael Liao'
+
+'''
+In-process stand-in servers that speak enough of memcache text protocol and
+RESP to serve MemcacheClient and RedisClient in tests and benchmarks.
+
+Usage:
+
+    s = MemcacheServer().start()
+    c = cache.MemcacheClient(s.address)
+    ...
+    s.stop()
+'''
+
+import time, socket, threading, logging, SocketServer
+
+class _Store(object):
+    '''
+    Dict of key -> (value, expires) guarded by lock, expired lazily.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = dict()
+
+    def get(self, key, now):
+        '''
+        Return value or None. Must hold lock.
+        '''
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        if entry[1] and entry[1] <= now:
+            del self.data[key]
+            return None
+        return entry[0]
+
+    def put(self, key, value, expires):
+        '''
+        Put value with absolute expire time (0 for never). Must hold lock.
+        '''
+        self.data[key] = (value, expires)
+
+    def remove(self, key, now):
+        '''
+        Remove key and return True if it existed. Must hold lock.
+        '''
+        return self.get(key, now) is not None and self.data.pop(key, None) is not None
+
+class _Server(SocketServer.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port), self.handler_class)
+        self.store = _Store()
+        self._thread = None
+
+    @property
+    def address(self):
+        '''
+        Server address as 'host:port'.
+        '''
+        return '%s:%s' % self.server_address
+
+    def start(self):
+        '''
+        Serve in a daemon thread and return self.
+        '''
+        self._thread = threading.Thread(target=self.serve_forever, name=self.__class__.__name__)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line or self.handle_line(line.rstrip('\r\n')) is False:
+                    return
+        except socket.error:
+            pass
+
+def _memcache_expires(exptime, now):
+    exptime = int(exptime)
+    if exptime < 0:
+        return now - 1
+    if exptime==0:
+        return 0
+    return exptime if exptime > 2592000 else now + exptime
+
+class _MemcacheHandler(_Handler):
+
+    def handle_line(self, line):
+        args = line.split()
+        if not args:
+            return
+        cmd = args[0]
+        noreply = args[-1]=='noreply'
+        if noreply:
+            args = args[:-1]
+        store = self.server.store
+        now = time.time()
+        if cmd in ('set', 'add', 'replace'):
+            key, flags, exptime, length = args[1], int(args[2]), args[3], int(args[4])
+            data = self.rfile.read(length + 2)[:length]
+            with store.lock:
+                exists = store.get(key, now) is not None
+                if (cmd=='add' and exists) or (cmd=='replace' and not exists):
+                    r = 'NOT_STORED'
+                else:
+                    store.put(key, (flags, data), _memcache_expires(exptime, now))
+                    r = 'STORED'
+        elif cmd in ('get', 'gets'):
+            L = []
+            with store.lock:
+                for key in args[1:]:
+                    v = store.get(key, now)
+                    if v is not None:
+                        L.append('VALUE %s %d %d%s\r\n%s' % (key, v[0], len(v[1]), ' 0' if cmd=='gets' else '', v[1]))
+            L.append('END')
+            r = '\r\n'.join(L)
+        elif cmd=='delete':
+            with store.lock:
+                r = 'DELETED' if store.remove(args[1], now) else 'NOT_FOUND'
+        elif cmd in ('incr', 'decr'):
+            key, delta = args[1], int(args[2])
+            with store.lock:
+                v = store.get(key, now)
+                if v is None:
+                    r = 'NOT_FOUND'
+                elif not v[1].isdigit():
+                    r = 'CLIENT_ERROR cannot increment or decrement non-numeric value'
+                else:
+                    n = int(v[1]) + delta if cmd=='incr' else max(0, int(v[1]) - delta)
+                    r = str(n)
+                    store.put(key, (v[0], r), store.data[key][1])
+        elif cmd=='touch':
+            with store.lock:
+                v = store.get(args[1], now)
+                if v is not None:
+                    store.put(args[1], v, _memcache_expires(args[2], now))
+                r = 'NOT_FOUND' if v is None else 'TOUCHED'
+        elif cmd=='flush_all':
+            with store.lock:
+                store.data.clear()
+            r = 'OK'
+        elif cmd=='version':
+            r = 'VERSION 1.4.0-transwarp'
+        elif cmd=='stats':
+            r = 'END'
+        elif cmd=='quit':
+            return False
+        else:
+            r = 'ERROR'
+        if not noreply:
+            self.wfile.write(r + '\r\n')
+
+class MemcacheServer(_Server):
+    '''
+    Memcache server of get, gets, set, add, replace, delete, incr, decr, touch,
+    flush_all and version commands.
+
+    >>> import cache
+    >>> s = MemcacheServer().start()
+    >>> c = cache.MemcacheClient(s.address)
+    >>> c.set('name', u'Python\u4e2d\u6587')
+    >>> c.sets({'a': 'A', 'b': [1, 2]})
+    >>> c.get('name'), c.gets('a', 'b', 'c')
+    (u'Python\u4e2d\u6587', ['A', [1, 2], None])
+    >>> c.add('a', 'X'), c.add('x', 'X')
+    (False, True)
+    >>> c.incr('hits'), c.incr('hits'), c.incrs_by({'hits': 10, 'stock': -1})
+    (1, 2, {'hits': 12, 'stock': 0})
+    >>> c.deletes('a', 'b')
+    >>> c.gets('a', 'b')
+    [None, None]
+    >>> c.set('tmp', 'Tmp', 1)
+    >>> time.sleep(1.1)
+    >>> c.get('tmp', 'Expired')
+    'Expired'
+    >>> s.stop()
+    '''
+    handler_class = _MemcacheHandler
+
+class _Status(str):
+    pass
+
+class _Error(str):
+    pass
+
+_OK = _Status('OK')
+
+# returned by command that sends replies by itself:
+_NOREPLY = object()
+
+def _resp(value):
+    '''
+    Encode value as RESP.
+
+    >>> _resp(None), _resp(1), _resp('abc'), _resp(_OK), _resp(['a', None])
+    ('$-1\\r\\n', ':1\\r\\n', '$3\\r\\nabc\\r\\n', '+OK\\r\\n', '*2\\r\\n$1\\r\\na\\r\\n$-1\\r\\n')
+    '''
+    if value is None:
+        return '$-1\r\n'
+    if isinstance(value, _Status):
+        return '+%s\r\n' % value
+    if isinstance(value, _Error):
+        return '-ERR %s\r\n' % value
+    if isinstance(value, (int, long)):
+        return ':%d\r\n' % value
+    if isinstance(value, (list, tuple)):
+        return '*%d\r\n%s' % (len(value), ''.join([_resp(v) for v in value]))
+    return '$%d\r\n%s\r\n' % (len(value), value)
+
+class _RedisHandler(_Handler):
+
+    def setup(self):
+        _Handler.setup(self)
+        self.write_lock = threading.Lock()
+        self.channels = set()
+
+    def finish(self):
+        with self.server.channels_lock:
+            for channel in self.channels:
+                self.server.channels[channel].discard(self)
+        _Handler.finish(self)
+
+    def send(self, value):
+        with self.write_lock:
+            self.wfile.write(_resp(value))
+
+    def handle_line(self, line):
+        if line.startswith('*'):
+            args = []
+            for i in range(int(line[1:])):
+                n = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(n + 2)[:n])
+        else:
+            args = line.split()
+        if not args:
+            return
+        cmd = args[0].upper()
+        fn = getattr(self, 'do_%s' % cmd, None)
+        if fn is None:
+            return self.send(_Error("unknown command '%s'" % args[0]))
+        try:
+            r = fn(time.time(), *args[1:])
+        except (TypeError, ValueError):
+            r = _Error('wrong arguments for \'%s\' command' % args[0])
+        if r is not _NOREPLY:
+            self.send(r)
+        if cmd=='QUIT':
+            return False
+
+    def _incr(self, now, key, delta):
+        store = self.server.store
+        with store.lock:
+            v = store.get(key, now)
+            if v is not None and not v.lstrip('-').isdigit():
+                return _Error('value is not an integer or out of range')
+            n = int(v or 0) + int(delta)
+            store.put(key, str(n), store.data[key][1] if v is not None else 0)
+            return n
+
+    def do_PING(self, now, message=None):
+        return _Status('PONG') if message is None else message
+
+    def do_ECHO(self, now, message):
+        return message
+
+    def do_SELECT(self, now, db):
+        return _OK
+
+    def do_CLIENT(self, now, *args):
+        return _OK
+
+    def do_QUIT(self, now):
+        return _OK
+
+    def do_GET(self, now, key):
+        with self.server.store.lock:
+            return self.server.store.get(key, now)
+
+    def do_MGET(self, now, *keys):
+        with self.server.store.lock:
+            return [self.server.store.get(key, now) for key in keys]
+
+    def do_SET(self, now, key, value, *options):
+        expires, nx, xx = 0, False, False
+        options = [o.upper() for o in options]
+        for i, o in enumerate(options):
+            if o=='EX':
+                expires = now + int(options[i + 1])
+            elif o=='PX':
+                expires = now + int(options[i + 1]) / 1000.0
+            elif o=='NX':
+                nx = True
+            elif o=='XX':
+                xx = True
+        store = self.server.store
+        with store.lock:
+            exists = store.get(key, now) is not None
+            if (nx and exists) or (xx and not exists):
+                return None
+            store.put(key, value, expires)
+        return _OK
+
+    def do_SETEX(self, now, key, seconds, value):
+        return self.do_SET(now, key, value, 'EX', seconds)
+
+    def do_DEL(self, now, *keys):
+        with self.server.store.lock:
+            return len([key for key in keys if self.server.store.remove(key, now)])
+
+    def do_EXISTS(self, now, *keys):
+        with self.server.store.lock:
+            return len([key for key in keys if self.server.store.get(key, now) is not None])
+
+    def do_EXPIRE(self, now, key, seconds):
+        store = self.server.store
+        with store.lock:
+            v = store.get(key, now)
+            if v is None:
+                return 0
+            store.put(key, v, now + int(seconds))
+            return 1
+
+    def do_TTL(self, now, key):
+        store = self.server.store
+        with store.lock:
+            if store.get(key, now) is None:
+                return -2
+            expires = store.data[key][1]
+            return int(round(expires - now)) if expires else -1
+
+    def do_INCR(self, now, key):
+        return self._incr(now, key, 1)
+
+    def do_INCRBY(self, now, key, delta):
+        return self._incr(now, key, int(delta))
+
+    def do_DECR(self, now, key):
+        return self._incr(now, key, -1)
+
+    def do_DECRBY(self, now, key, delta):
+        return self._incr(now, key, -int(delta))
+
+    def do_FLUSHDB(self, now, *args):
+        with self.server.store.lock:
+            self.server.store.data.clear()
+        return _OK
+
+    do_FLUSHALL = do_FLUSHDB
+
+    def do_PUBLISH(self, now, channel, message):
+        with self.server.channels_lock:
+            handlers = list(self.server.channels.get(channel, ()))
+        for h in handlers:
+            try:
+                h.send(['message', channel, message])
+            except socket.error:
+                pass
+        return len(handlers)
+
+    def do_SUBSCRIBE(self, now, *channels):
+        for channel in channels:
+            with self.server.channels_lock:
+                self.server.channels.setdefault(channel, set()).add(self)
+            self.channels.add(channel)
+            self.send(['subscribe', channel, len(self.channels)])
+        return _NOREPLY
+
+    def do_UNSUBSCRIBE(self, now, *channels):
+        for channel in channels or list(self.channels):
+            with self.server.channels_lock:
+                self.server.channels.get(channel, set()).discard(self)
+            self.channels.discard(channel)
+            self.send(['unsubscribe', channel, len(self.channels)])
+        return _NOREPLY
+
+class RedisServer(_Server):
+    '''
+    Redis server of string, counter, expire and pub/sub commands.
+
+    >>> import cache
+    >>> s = RedisServer().start()
+    >>> c = cache.RedisClient(s.address)
+    >>> c.set('name', u'Python\u4e2d\u6587')
+    >>> c.sets({'a': 'A', 'b': [1, 2]})
+    >>> c.get('name'), c.gets('a', 'b', 'c')
+    (u'Python\u4e2d\u6587', ['A', [1, 2], None])
+    >>> c.add('a', 'X'), c.add('x', 'X')
+    (False, True)
+    >>> c.incr('hits'), c.incr('hits'), sorted(c.incrs_by({'hits': 10, 'stock': -1}).items())
+    (1, 2, [('hits', 12), ('stock', -1)])
+    >>> c.deletes('a', 'b')
+    >>> c.gets('a', 'b')
+    [None, None]
+    >>> msgs = []
+    >>> t = c.subscribe('news', msgs.append)
+    >>> time.sleep(0.2)
+    >>> c.publish('news', 'Hello')
+    >>> time.sleep(0.2)
+    >>> msgs
+    ['Hello']
+    >>> s.stop()
+    '''
+    handler_class = _RedisHandler
+
+    def __init__(self, host='127.0.0.1', port=0):
+        _Server.__init__(self, host, port)
+        self.channels = dict()
+        self.channels_lock = threading.Lock()
+
+def serve_defaults():
+    '''
+    Start MemcacheServer on port 11211 and RedisServer on port 6379 of localhost
+    if the port is free, and return list of started servers.
+    '''
+    servers = []
+    for cls, port in ((MemcacheServer, 11211), (RedisServer, 6379)):
+        try:
+            servers.append(cls('localhost', port).start())
+        except socket.error:
+            logging.info('port %s in use, not starting %s.' % (port, cls.__name__))
+    return servers
+
+if __name__=='__main__':
+    import doctest
+    doctest.testmod()
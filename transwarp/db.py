@@ -24,12 +24,254 @@ def next_str(t=None):
 
 next_id = next_str
 
+# 41-bit ms timestamp | 12-bit node | 2-bit thread slot | 8-bit sequence:
+_ID_EPOCH = 1325376000000 # 2012-01-01 00:00:00 UTC in ms
+_ID_NODE_BITS = 12
+_ID_SLOT_BITS = 2
+_ID_SEQ_BITS = 8
+_ID_SLOTS = 1 << _ID_SLOT_BITS
+_ID_SEQ_MAX = (1 << _ID_SEQ_BITS) - 1
+_ID_NODE_MASK = (1 << _ID_NODE_BITS) - 1
+
+class _IdSlot(object):
+    '''
+    Sequence state of a slot, owned by one thread at a time.
+    '''
+    def __init__(self, slot):
+        self.slot = slot << _ID_SEQ_BITS
+        self.last = 0
+        self.seq = 0
+
+class _IdSlotRef(object):
+    '''
+    Thread local reference to a slot that returns the slot to pool when thread exits.
+    '''
+    def __init__(self, pool, slot):
+        self.pool = pool
+        self.slot = slot
+
+    def __del__(self):
+        self.pool.append(self.slot)
+
+class IdGenerator(object):
+    '''
+    Generate time-ordered ids as 63-bit int, made of 41-bit ms timestamp, 
+    12-bit node, 2-bit thread slot and 8-bit sequence.
+
+    Each thread owns a slot so no lock is needed to generate id. Threads 
+    beyond the slot pool share slot 0 that is guarded by a lock. When the 
+    sequence of a slot is exhausted in one ms, it waits for the next ms so 
+    timestamp of ids never runs ahead of clock.
+
+    The node must be unique for each process that generates ids. The default 
+    node is computed from host name and pid, which is unique for processes of 
+    one host (unless pids differ by a multiple of 4096) but may collide across 
+    hosts, so pass node explicitly if ids of many hosts are stored together. 
+    After fork the default node is computed again by pid of the child, but an 
+    explicit node is kept, so call init_id_generator() in each worker.
+
+    >>> g = IdGenerator(3)
+    >>> L = [g.next_long() for i in range(2000)]
+    >>> L==sorted(L) and len(set(L))==2000
+    True
+    >>> (L[0] >> 10) & 0xfff
+    3
+    >>> len(g.next_str())
+    16
+    >>> L = [g.next_long() for i in range(50000)]
+    >>> (L[-1] >> 22) + _ID_EPOCH <= time.time() * 1000
+    True
+    >>> def gen(L):
+    ...     L.extend([g.next_long() for i in range(1000)])
+    >>> ts = [threading.Thread(target=gen, args=(L,)) for i in range(80)]
+    >>> for t in ts: t.start()
+    >>> for t in ts: t.join()
+    >>> len(L)==len(set(L))
+    True
+    >>> import tempfile, shutil
+    >>> g = IdGenerator()
+    >>> x = g.next_long()
+    >>> d = tempfile.mkdtemp()
+    >>> pids = []
+    >>> for n in range(4):
+    ...     pid = os.fork()
+    ...     if pid==0:
+    ...         with open(os.path.join(d, str(n)), 'w') as f:
+    ...             f.write(' '.join([str(g.next_long()) for i in range(20000)]))
+    ...         os._exit(0)
+    ...     pids.append(pid)
+    >>> for pid in pids:
+    ...     r = os.waitpid(pid, 0)
+    >>> L = []
+    >>> for n in range(4):
+    ...     L.extend(open(os.path.join(d, str(n))).read().split())
+    >>> shutil.rmtree(d)
+    >>> len(L), len(set(L))
+    (80000, 80000)
+    '''
+    def __init__(self, node=None):
+        '''
+        Init generator with node id (0-4095) that is unique per process, default to 
+        a value computed from host name and pid.
+        '''
+        self._explicit = node
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        node = self._explicit
+        if node is None:
+            node = (hash(socket.gethostname()) << 7) ^ self._pid
+        self._node = (node & _ID_NODE_MASK) << (_ID_SLOT_BITS + _ID_SEQ_BITS)
+        self._pool = [_IdSlot(n) for n in range(_ID_SLOTS - 1, 0, -1)]
+        self._shared = _IdSlot(0)
+        self._local = threading.local()
+
+    def _acquire(self):
+        try:
+            return _IdSlotRef(self._pool, self._pool.pop())
+        except IndexError:
+            logging.debug('no free id slot, fall back to shared slot.')
+            return None
+
+    def _next(self, s):
+        t = int(time.time() * 1000) - _ID_EPOCH
+        if t > s.last:
+            s.last = t
+            s.seq = 0
+        else:
+            # same ms or clock moved back:
+            s.seq = s.seq + 1
+            if s.seq > _ID_SEQ_MAX:
+                while t <= s.last:
+                    time.sleep(0.0001)
+                    t = int(time.time() * 1000) - _ID_EPOCH
+                s.last = t
+                s.seq = 0
+        return (s.last << 22) | self._node | s.slot | s.seq
+
+    def next_long(self):
+        '''
+        Return next id as int.
+        '''
+        if os.getpid()!=self._pid:
+            # forked: slots and default node are copied from parent:
+            with self._lock:
+                if os.getpid()!=self._pid:
+                    self._reset()
+        try:
+            ref = self._local.ref
+        except AttributeError:
+            ref = self._local.ref = self._acquire()
+        if ref is None:
+            with self._lock:
+                return self._next(self._shared)
+        return self._next(ref.slot)
+
+    def next_str(self):
+        '''
+        Return next id as 16-char hex string which sorts as the int id.
+        '''
+        return '%016x' % self.next_long()
+
+_id_generator = IdGenerator()
+
+def init_id_generator(node):
+    '''
+    Re-init the global id generator with node id (0-4095) that is unique per process.
+    '''
+    global _id_generator
+    _id_generator = IdGenerator(node)
+
+def next_long():
+    '''
+    Return next id as time-ordered 63-bit int. See IdGenerator.
+    '''
+    return _id_generator.next_long()
+
+def next_short_str():
+    '''
+    Return next id as time-ordered 16-char string. See IdGenerator.
+    '''
+    return _id_generator.next_str()
+
+class LogSink(object):
+    '''
+    Sink that receives db instrumentation and writes to logging. Statements are 
+    logged as DEBUG, profiling as INFO or WARNING if slow. Messages are only 
+    formatted when the level is enabled.
+
+    Any object has statement(sql, args) and profiling(t, sql) can be used as 
+    sink (e.g. to emit metrics), see init_sink().
+
+    >>> s = LogSink(max_args=3, max_arg_len=8)
+    >>> s.format_args((1, 'abc', 'a long string', None, 2.0))
+    "(1, 'abc', 'a long ..., ...2 more)"
+    >>> LogSink(redact=True).format_args(('alice', 'secret'))
+    '(?, ?)'
+    >>> LogSink(redact=lambda sql, args: args[:1] + ('***',)).format_args(('alice', 'secret'))
+    "('alice', '***')"
+    '''
+    def __init__(self, slow=0.1, max_args=20, max_arg_len=100, redact=None):
+        '''
+        Init LogSink.
+
+        Args:
+            slow: seconds that statement is logged as WARNING, default to 0.1.
+            max_args: max number of args to log, default to 20.
+            max_arg_len: max length of each arg to log, default to 100.
+            redact: True to hide all args, or a function redact(sql, args) that returns args to log.
+        '''
+        self.slow = slow
+        self.max_args = max_args
+        self.max_arg_len = max_arg_len
+        self.redact = redact
+
+    def format_args(self, args, sql=''):
+        if self.redact is True:
+            return '(%s)' % ', '.join(['?'] * len(args))
+        if self.redact:
+            args = self.redact(sql, args)
+        L = []
+        for arg in args[:self.max_args]:
+            r = repr(arg)
+            L.append(r if len(r) <= self.max_arg_len else '%s...' % r[:self.max_arg_len])
+        if len(args) > self.max_args:
+            L.append('...%d more' % (len(args) - self.max_args))
+        return '(%s)' % ', '.join(L)
+
+    def statement(self, sql, args):
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('SQL: %s, ARGS: %s', sql, self.format_args(args, sql))
+
+    def profiling(self, t, sql):
+        if t > self.slow:
+            logging.warning('[PROFILING] [DB] %s: %s', t, sql)
+        elif logging.root.isEnabledFor(logging.INFO):
+            logging.info('[PROFILING] [DB] %s: %s', t, sql)
+
+_db_sink = LogSink()
+
+def init_sink(sink):
+    '''
+    Set sink of db instrumentation, e.g. LogSink(redact=True), or None to disable.
+    '''
+    global _db_sink
+    _db_sink = sink
+
 def _profiling(start, sql=''):
     t = time.time() - start
-    if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
-    else:
-        logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
+    if _db_sink:
+        _db_sink.profiling(t, sql)
+    if _db_ctx.budgets:
+        for b in _db_ctx.budgets:
+            b.account(t, sql)
+
+def _check_budgets(sql):
+    if _db_ctx.budgets:
+        for b in _db_ctx.budgets:
+            b.check(sql)
 
 class DBError(Exception):
     pass
@@ -37,6 +279,9 @@ class DBError(Exception):
 class MultiColumnsError(DBError):
     pass
 
+class BudgetExceededError(DBError):
+    pass
+
 def _log(s):
     logging.debug(s)
 
@@ -80,6 +325,7 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.budgets = []
 
     def is_init(self):
         return not self.connection is None
@@ -254,13 +500,136 @@ def with_transaction(func):
         _profiling(_start)
     return _wrapper
 
+class _BudgetCtx(object):
+    '''
+    _BudgetCtx object that counts statements and db time executed in the scope. 
+    _BudgetCtx object can be nested and each one is checked independently.
+    '''
+    def __init__(self, max_queries, max_time, on_exceed):
+        self.max_queries = max_queries
+        self.max_time = max_time
+        self.on_exceed = on_exceed
+        self.queries = 0
+        self.time = 0.0
+        self.exceeded = False
+
+    def __enter__(self):
+        global _db_ctx
+        _db_ctx.budgets.append(self)
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        global _db_ctx
+        _db_ctx.budgets.remove(self)
+
+    def _over(self, queries):
+        if self.max_queries is not None and queries > self.max_queries:
+            return '%d queries exceed budget of %d queries' % (queries, self.max_queries)
+        if self.max_time is not None and self.time > self.max_time:
+            return '%s seconds exceed budget of %s seconds' % (self.time, self.max_time)
+        return None
+
+    def check(self, sql):
+        '''
+        Called before a statement is executed: raise BudgetExceededError if on_exceed 
+        is 'raise' and the statement would exceed the budget, so that it is never 
+        executed (or auto-committed) and never hides the error of a failed statement.
+        '''
+        if self.exceeded or self.on_exceed!='raise':
+            return
+        msg = self._over(self.queries + 1)
+        if msg:
+            self.exceeded = True
+            raise BudgetExceededError(msg)
+
+    def account(self, t, sql):
+        self.queries = self.queries + 1
+        self.time = self.time + t
+        if self.exceeded or self.on_exceed=='raise':
+            return
+        msg = self._over(self.queries)
+        if not msg:
+            return
+        self.exceeded = True
+        if callable(self.on_exceed):
+            self.on_exceed(self, sql)
+        else:
+            logging.warning('[BUDGET] [DB] %s: %s' % (msg, sql))
+
+def budget(max_queries=None, max_time=None, on_exceed='warning'):
+    '''
+    Return _BudgetCtx object that limits number of statements and total db time 
+    (in seconds) executed in the scope, can be used by 'with' statement:
+
+    with budget(max_queries=20, max_time=0.2):
+        pass
+
+    When budget exceeded at the first time, log warning if on_exceed is 'warning', 
+    raise BudgetExceededError if on_exceed is 'raise', or call on_exceed(budget, sql) 
+    if on_exceed is callable (e.g. emit a metric).
+
+    With on_exceed='raise' the budget is checked before each statement: the statement 
+    that would exceed max_queries is not executed, and the statement after max_time 
+    is used up is not executed. A failed statement always raises its own error.
+
+    >>> with budget(max_queries=2, on_exceed='raise') as b:
+    ...     for i in range(3):
+    ...         n = select_int('select count(*) from user')
+    Traceback (most recent call last):
+      ...
+    BudgetExceededError: 3 queries exceed budget of 2 queries
+    >>> with budget(max_time=0, on_exceed='raise') as b:
+    ...     select('select * from no_such_table')
+    Traceback (most recent call last):
+      ...
+    OperationalError: no such table: no_such_table
+    >>> n = update('delete from user where id=?', 96800)
+    >>> with budget(max_queries=1, on_exceed='raise') as b:
+    ...     n = select_int('select count(*) from user')
+    ...     n = insert('user', id=96800, name='Budget', email='budget@test.org', passwd='', last_modified=0)
+    Traceback (most recent call last):
+      ...
+    BudgetExceededError: 2 queries exceed budget of 1 queries
+    >>> select_int('select count(*) from user where id=?', 96800)
+    0
+    >>> L = []
+    >>> with budget(max_queries=1, on_exceed=lambda b, sql: L.append(sql)) as b:
+    ...     with budget(max_time=60) as b2:
+    ...         for i in range(3):
+    ...             n = select_int('select count(*) from user')
+    >>> b.queries, b2.queries, b2.exceeded
+    (3, 3, False)
+    >>> L
+    ['select count(*) from user']
+    '''
+    return _BudgetCtx(max_queries, max_time, on_exceed)
+
+def with_budget(max_queries=None, max_time=None, on_exceed='warning'):
+    '''
+    A decorator that makes function (e.g. a web route) around a budget.
+
+    @with_budget(max_queries=20, max_time=0.2)
+    def foo(*args, **kw):
+        f1()
+        f2()
+    '''
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            with _BudgetCtx(max_queries, max_time, on_exceed):
+                return func(*args, **kw)
+        return _wrapper
+    return _decorator
+
 def _select(sql, first, *args):
     ' execute select SQL and return unique result or list results.'
     global _db_ctx, _db_convert
     cursor = None
     if _db_convert != '?':
         sql = sql.replace('?', _db_convert)
-    _log('SQL: %s, ARGS: %s' % (sql, args))
+    _check_budgets(sql)
+    if _db_sink:
+        _db_sink.statement(sql, args)
     start = time.time()
     try:
         cursor = _db_ctx.connection.cursor()
@@ -362,7 +731,9 @@ def _update(sql, args, post_fn=None):
     cursor = None
     if _db_convert != '?':
         sql = sql.replace('?', _db_convert)
-    _log('SQL: %s, ARGS: %s' % (sql, args))
+    _check_budgets(sql)
+    if _db_sink:
+        _db_sink.statement(sql, args)
     start = time.time()
     try:
         cursor = _db_ctx.connection.cursor()
@@ -513,6 +884,8 @@ class Field(object):
         self.updatable = kw.get('updatable', True)
         self.insertable = kw.get('insertable', True)
         self.ddl = kw.get('ddl', '')
+        self.ref = kw.get('ref', None)
+        self.ref_name = kw.get('ref_name', None)
 
         self._order = Field._count
         Field._count = Field._count + 1
@@ -582,6 +955,9 @@ class VersionField(Field):
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
+# max number of ids in one 'in (...)' clause when prefetching references:
+_PREFETCH_BATCH = 500
+
 _triggers = ('post_get_by_id', 'pre_insert', 'post_insert', 'pre_update', 'post_update', 'pre_delete', 'post_delete')
 
 def _gen_sql(table_name, mappings):
@@ -612,13 +988,12 @@ class ModelMetaclass(type):
         # store all subclasses info:
         if not hasattr(cls, 'subclasses'):
             cls.subclasses = {}
-        if not name in cls.subclasses:
-            cls.subclasses[name] = name
-        else:
+        if name in cls.subclasses:
             logging.warning('Redefine class: %s' % name)
 
         logging.info('Scan ORMapping %s...' % name)
         mappings = dict()
+        references = dict()
         primary_key = None
         for k, v in attrs.iteritems():
             if isinstance(v, Field):
@@ -636,6 +1011,15 @@ class ModelMetaclass(type):
                         logging.warning('NOTE: change primary key to non-nullable.')
                         v.nullable = False
                     primary_key = v
+                if v.ref:
+                    ref_name = v.ref_name
+                    if not ref_name:
+                        if not k.endswith('_id'):
+                            raise TypeError('ref_name required for field: %s' % k)
+                        ref_name = k[:-3]
+                    if ref_name in attrs or ref_name in references:
+                        raise TypeError('Duplicate ref_name "%s" in class: %s' % (ref_name, name))
+                    references[ref_name] = k
                 mappings[k] = v
         # check exist of primary key:
         if not primary_key:
@@ -646,13 +1030,16 @@ class ModelMetaclass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
+        attrs['__references__'] = references
         def _sql(self):
             return _gen_sql(attrs['__table__'], mappings)
         attrs['__sql__'] = _sql
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
-        return type.__new__(cls, name, bases, attrs)
+        new_cls = type.__new__(cls, name, bases, attrs)
+        cls.subclasses[name] = new_cls
+        return new_cls
 
 class Model(dict):
     '''
@@ -720,13 +1107,80 @@ class Model(dict):
         return cls(**d) if d else None
 
     @classmethod
-    def select(cls, where, *args):
+    def select(cls, where, *args, **kw):
         '''
-        Find by where clause and return list.
+        Find by where clause and return list. References can be loaded by 
+        passing prefetch=('ref_name', ...), see prefetch().
         '''
         L = select('select * from %s %s' % (cls.__table__, where), *args) if where else \
             select('select * from %s' % cls.__table__)
-        return [cls(**d) for d in L]
+        L = [cls(**d) for d in L]
+        prefetch = kw.get('prefetch')
+        if prefetch:
+            if isinstance(prefetch, basestring):
+                prefetch = (prefetch,)
+            cls.prefetch(L, *prefetch)
+        return L
+
+    @classmethod
+    def prefetch(cls, models, *names):
+        '''
+        Load referenced objects of models by one 'in' query per reference, 
+        and attach them to each model as ref name.
+
+        A reference is declared by field with ref=Model (or model class name), 
+        and the ref name is the field name without '_id' or given by ref_name.
+
+        >>> class Author(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField()
+        >>> class Article(Model):
+        ...     id = IntegerField(primary_key=True)
+        ...     author_id = IntegerField(ref=Author)
+        ...     editor_id = IntegerField(ref='Author', ref_name='editor', nullable=True)
+        ...     title = StringField()
+        >>> n = update('create table author (id int primary key, name text)')
+        >>> n = update('create table article (id int primary key, author_id int, editor_id int, title text)')
+        >>> for i in range(1, 4):
+        ...     r = Author(id=i, name='Author-%s' % i).insert()
+        >>> for i in range(1, 7):
+        ...     r = Article(id=i, author_id=i % 3 + 1, editor_id=1 if i % 2 else None, title='Title-%s' % i).insert()
+        >>> L = Article.select('order by id', prefetch=('author', 'editor'))
+        >>> [(a.title, a.author.name) for a in L[:3]]
+        [(u'Title-1', u'Author-2'), (u'Title-2', u'Author-3'), (u'Title-3', u'Author-1')]
+        >>> L[0].editor.name, L[1].editor
+        (u'Author-1', None)
+        >>> L[0].author is L[3].author
+        True
+        >>> Article.prefetch(L, 'title')
+        Traceback (most recent call last):
+          ...
+        ValueError: No reference "title" in Article.
+        '''
+        for name in names:
+            if not name in cls.__references__:
+                raise ValueError('No reference "%s" in %s.' % (name, cls.__name__))
+        with _ConnectionCtx():
+            for name in names:
+                cls._prefetch(models, name)
+        return models
+
+    @classmethod
+    def _prefetch(cls, models, name):
+        k = cls.__references__[name]
+        ref_cls = cls.__mappings__[k].ref
+        if isinstance(ref_cls, basestring):
+            ref_cls = ModelMetaclass.subclasses[ref_cls]
+        ids = list(set([m.get(k) for m in models if m.get(k) is not None]))
+        pk = ref_cls.__primary_key__.name
+        refs = dict()
+        for n in range(0, len(ids), _PREFETCH_BATCH):
+            batch = ids[n:n+_PREFETCH_BATCH]
+            sql = 'select * from %s where %s in (%s)' % (ref_cls.__table__, pk, ','.join(['?'] * len(batch)))
+            for d in select(sql, *batch):
+                refs[d[pk]] = ref_cls(**d)
+        for m in models:
+            m[name] = refs.get(m.get(k))
 
     @classmethod
     def count(cls, where, *args):
@@ -440,6 +440,198 @@ class Route(object):
 
     __repr__ = __str__
 
+class LinearRouter(object):
+    '''
+    Router that tries regex of each route in order.
+    '''
+    def __init__(self, routes):
+        self.routes = list(routes)
+
+    def match(self, path):
+        '''
+        Return (route, kw) of the first route that matches path, or (None, None).
+        '''
+        for r in self.routes:
+            m = r.route.match(path)
+            if m:
+                return r, m.groupdict()
+        return None, None
+
+class _TrieNode(object):
+
+    def __init__(self):
+        self.statics = {}
+        self.var = None
+        self.patterns = []
+        self.tails = []
+        self.end = None
+        self.min_index = sys.maxint
+
+class TrieRouter(object):
+    '''
+    Router that matches path segment by segment. Static segments are looked up by 
+    dict, <var> segments match any non-empty segment, segments mixed with static 
+    text are matched by regex, and routes with <path:var> are matched by route regex 
+    from the segment of the path var. The first route in order wins as LinearRouter.
+
+    >>> f = lambda **kw: kw
+    >>> paths = ('/blog/<id>', '/blog/<id>.html', '/blog/new/<x>', '/blog/new/edit',
+    ...          '/<user>/edit', '/a-<x>-<y>', '/files/<path:p>.js', '/static/<path:path>', '/favicon.ico')
+    >>> routes = [Route(p, f) for p in paths]
+    >>> t = TrieRouter(routes)
+    >>> r, kw = t.match('/blog/123.html')
+    >>> r.str_route, kw
+    ('/blog/<id>', {'id': '123.html'})
+    >>> r, kw = t.match('/a-b-c')
+    >>> r.str_route, sorted(kw.items())
+    ('/a-<x>-<y>', [('x', 'b'), ('y', 'c')])
+    >>> r, kw = t.match('/files/js/app.min.js')
+    >>> r.str_route, kw
+    ('/files/<path:p>.js', {'p': 'js/app.min'})
+    >>> t.match('/blog/'), t.match('/no/such/path')
+    ((None, None), (None, None))
+    >>> l = LinearRouter(routes)
+    >>> tests = ['/blog/1', '/blog/new/edit', '/bob/edit', '/blog/edit', '/a-1-2-3', '/a--1', '/files/.js',
+    ...          '/static/a/b.css', '/static/', '/favicon.ico', '/favicon.ico/', '//edit', '/blog/new/']
+    >>> [t.match(p)[0] for p in tests]==[l.match(p)[0] for p in tests]
+    True
+    '''
+    def __init__(self, routes):
+        self.routes = list(routes)
+        self._root = _TrieNode()
+        for index, r in enumerate(self.routes):
+            self._add(index, r)
+
+    def _add(self, index, r):
+        node = self._root
+        node.min_index = min(node.min_index, index)
+        for seg in r.str_route.split('/'):
+            parts = _re_route.split(seg)
+            types = [r._parse_var(v)[0] for v in parts[1::2]]
+            if 'path' in types:
+                node.tails.append((index, r))
+                return
+            if len(parts)==1:
+                child = node.statics.get(seg)
+                if child is None:
+                    child = node.statics[seg] = _TrieNode()
+                node = child
+            elif len(parts)==3 and not parts[0] and not parts[2]:
+                if node.var is None:
+                    node.var = _TrieNode()
+                node = node.var
+            else:
+                L = ['^']
+                for i, part in enumerate(parts):
+                    L.append(r'[^\/]+' if i % 2 else r._parse_static(part))
+                L.append('$')
+                pattern = ''.join(L)
+                for p, child in node.patterns:
+                    if p.pattern==pattern:
+                        node = child
+                        break
+                else:
+                    child = _TrieNode()
+                    node.patterns.append((re.compile(pattern), child))
+                    node = child
+            node.min_index = min(node.min_index, index)
+        if node.end is None:
+            node.end = (index, r)
+
+    def _search(self, node, path, segs, i, best):
+        for index, r in node.tails:
+            if index < best[0] and r.route.match(path):
+                best[0], best[1] = index, r
+                break
+        if i==len(segs):
+            if node.end and node.end[0] < best[0]:
+                best[0], best[1] = node.end
+            return
+        seg = segs[i]
+        children = []
+        child = node.statics.get(seg)
+        if child:
+            children.append(child)
+        if seg and node.var:
+            children.append(node.var)
+        for p, child in node.patterns:
+            if p.match(seg):
+                children.append(child)
+        if len(children) > 1:
+            children.sort(key=lambda c: c.min_index)
+        for child in children:
+            if child.min_index < best[0]:
+                self._search(child, path, segs, i + 1, best)
+
+    def match(self, path):
+        '''
+        Return (route, kw) of the first route that matches path, or (None, None).
+        '''
+        best = [sys.maxint, None]
+        self._search(self._root, path, path.split('/'), 0, best)
+        if best[1] is None:
+            return None, None
+        m = best[1].route.match(path)
+        return (best[1], m.groupdict()) if m else (None, None)
+
+_re_group = re.compile(r'\(\?P\<(\w+)\>')
+
+class RegexRouter(object):
+    '''
+    Router that compiles routes into alternation regex with named groups, so one 
+    match() finds the first matched route. Python 2 allows 100 named groups in one 
+    regex, so routes are split into chunks that are tried in order.
+
+    >>> f = lambda **kw: kw
+    >>> routes = [Route('/blog/<id>', f), Route('/blog/<id>.html', f), Route('/<user>/<id>', f)]
+    >>> routes.extend([Route('/r%d/<id>/edit' % i, f) for i in range(100)])
+    >>> r = RegexRouter(routes)
+    >>> len(r._chunks)
+    3
+    >>> [(x.str_route, kw) for x, kw in [r.match('/blog/1.html'), r.match('/bob/2'), r.match('/r99/3/edit')]]
+    [('/blog/<id>', {'id': '1.html'}), ('/<user>/<id>', {'user': 'bob', 'id': '2'}), ('/r99/<id>/edit', {'id': '3'})]
+    >>> r.match('/r99/3/4')
+    (None, None)
+    '''
+    def __init__(self, routes, max_groups=99):
+        self.routes = list(routes)
+        self._chunks = []
+        L, groups = [], 0
+        for index, r in enumerate(self.routes):
+            n = len(r.types) + 1
+            if L and groups + n > max_groups:
+                self._chunks.append(self._compile(L))
+                L, groups = [], 0
+            L.append((index, r))
+            groups = groups + n
+        if L:
+            self._chunks.append(self._compile(L))
+
+    def _compile(self, L):
+        alts = []
+        names = {}
+        for index, r in L:
+            vars = []
+            def _rename(m):
+                vars.append((m.group(1), '_%d_%s' % (index, m.group(1))))
+                return '(?P<%s>' % vars[-1][1]
+            alts.append('(?P<_%d>%s)' % (index, _re_group.sub(_rename, r.re_route[1:-1])))
+            names['_%d' % index] = (r, vars)
+        return re.compile('^(?:%s)$' % '|'.join(alts)), names
+
+    def match(self, path):
+        '''
+        Return (route, kw) of the first route that matches path, or (None, None).
+        '''
+        for regex, names in self._chunks:
+            m = regex.match(path)
+            if m:
+                r, vars = names[m.lastgroup]
+                return r, dict([(name, m.group(group)) for name, group in vars])
+        return None, None
+
+_routers = dict(linear=LinearRouter, trie=TrieRouter, regex=RegexRouter)
+
 def _static_file_generator(fpath):
     BLOCK_SIZE = 8192
     with open(fpath, 'rb') as f:
@@ -1168,6 +1360,22 @@ class Template(object):
         if '_' in __builtin__.__dict__:
             self.model['_'] = _
 
+    def __getstate__(self):
+        '''
+        Pickle template without gettext function '_' so it can be cached.
+
+        >>> import pickle
+        >>> t = pickle.loads(pickle.dumps(Template('hello.html', title='Hello', _=lambda s: s)))
+        >>> t.template_name, t.model['title']
+        ('hello.html', 'Hello')
+        '''
+        model = dict(self.model)
+        model.pop('_', None)
+        return self.template_name, model
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
 def _init_jinja2(templ_dir, **kw):
     '''
     Render using jinja2.
@@ -1455,6 +1663,7 @@ class WSGIApplication(object):
                 shouldreload = True
         if shouldreload:
             self.get_static_routes, self.post_static_routes, self.get_re_routes, self.post_re_routes = self._parse_routes(self.modules, self._debug)
+            self._make_routers()
 
     def _parse_modules(self, modules, debug):
         L = []
@@ -1497,6 +1706,10 @@ class WSGIApplication(object):
         get_re_routes.append(Route('/favicon.ico', favicon_handler))
         return get_static_routes, post_static_routes, get_re_routes, post_re_routes
 
+    def _make_routers(self):
+        self._get_router = self._router_class(self.get_re_routes)
+        self._post_router = self._router_class(self.post_re_routes)
+
     def _mkfilters(self, filters):
         if filters:
             L = list(filters)
@@ -1519,11 +1732,19 @@ class WSGIApplication(object):
                            The built-in supported template engines are 'mako', 'jinja2' and 'cheetah'.
           kw: keywords args:
               DEBUG = True|False, default to False. Modules will automatically reloaded if changed in debug mode.
+              WARM_UP = True|list of namespaces, default to False. Run cache warmers registered by 
+                        @cache.warmer in a background thread after routes are loaded. Every process 
+                        that builds the app tries, but only the first one in 5 minutes runs the warmers 
+                        if processes share cache.client (e.g. memcache or redis).
+              ROUTER = 'trie'|'regex'|'linear', default to 'trie'. Dispatcher of routes with vars.
         '''
         self._debug = kw.pop('DEBUG', False)
+        warm_up = kw.pop('WARM_UP', False)
+        self._router_class = _routers[kw.pop('ROUTER', 'trie')]
         self.modules = self._parse_modules(modules, self._debug)
         self._filters = self._mkfilters(filters)
         self.get_static_routes, self.post_static_routes, self.get_re_routes, self.post_re_routes = self._parse_routes(self.modules, self._debug)
+        self._make_routers()
         self.error_handler = _default_error_handler
         self.document_root = document_root
         self._application = Dict(document_root=document_root, debug=self._debug)
@@ -1534,6 +1755,13 @@ class WSGIApplication(object):
         elif callable(template_engine):
             self.template_render = template_engine
 
+        if warm_up:
+            import cache
+            t = threading.Thread(target=cache.warm_up, args=(None if warm_up is True else warm_up,), \
+                    kwargs=dict(lock_expires=300), name='cache-warm-up')
+            t.daemon = True
+            t.start()
+
     def _exec(self, r, kw, start_response):
         global ctx
         exec_start = time.time()
@@ -1596,14 +1824,9 @@ class WSGIApplication(object):
         if r:
             _log('matched static route: %s' % path_info)
         else:
-            re_routes = self.get_re_routes if is_get else self.post_re_routes
-            for rt in re_routes:
-                m = rt.route.match(path_info)
-                if m:
-                    r = rt
-                    kw = m.groupdict()
-                    _log('matched regex route: %s' % path_info)
-                    break
+            r, kw = (self._get_router if is_get else self._post_router).match(path_info)
+            if r:
+                _log('matched regex route: %s' % path_info)
         if not r:
             _log('no route matched: %s' % path_info)
             return self.error_handler(HttpError(404), start_response, self._debug)